@@ -39,6 +39,7 @@
 import re, string, sys
 import mimetools, StringIO
 from elementtree import ElementTree
+from textutils import LineIndex
 
 class recollector:
     def __init__(self):
@@ -145,13 +146,170 @@ html_cannot_contain_block_tags = set([
 
 html_close_tag_unnecessary = html_no_close_tags.union(html_optional_close_tags)
 
+class HTMLElement(object):
+    """A compact element for HTML trees.
+
+    This implements the ElementTree element interface, plus the `ns`,
+    `localName`, `start`, `end` and `parent` attributes used by the
+    tree service. It uses `__slots__`, a `parent` pointer instead of an
+    entry in a {child: parent} dict, and stores the start and end
+    (line, col, offset) positions as plain ints, creating the tuples
+    only when `start` or `end` is read.
+    """
+    __slots__ = ("tag", "attrib", "text", "tail", "_children",
+                 "ns", "localName", "parent",
+                 "_startLine", "_startCol", "_startOffset",
+                 "_endLine", "_endCol", "_endOffset")
+
+    def __init__(self, tag, attrib={}, **extra):
+        attrib = attrib.copy()
+        attrib.update(extra)
+        self.tag = tag
+        self.attrib = attrib
+        self.text = None
+        self.tail = None
+        self._children = []
+        self.ns = None
+        self.localName = tag
+        self.parent = None
+        self._startLine = -1
+        self._endLine = -1
+
+    def __repr__(self):
+        return "<Element %s at %x>" % (repr(self.tag), id(self))
+
+    def _get_start(self):
+        if self._startLine < 0:
+            return None
+        return (self._startLine, self._startCol, self._startOffset)
+    def _set_start(self, start):
+        if start is None:
+            self._startLine = -1
+        else:
+            self._startLine, self._startCol, self._startOffset = start
+    start = property(_get_start, _set_start)
+
+    def _get_end(self):
+        if self._endLine < 0:
+            return None
+        return (self._endLine, self._endCol, self._endOffset)
+    def _set_end(self, end):
+        if end is None:
+            self._endLine = -1
+        else:
+            self._endLine, self._endCol, self._endOffset = end
+    end = property(_get_end, _set_end)
+
+    def makeelement(self, tag, attrib):
+        return HTMLElement(tag, attrib)
+
+    def __len__(self):
+        return len(self._children)
+
+    def __getitem__(self, index):
+        return self._children[index]
+
+    def __setitem__(self, index, element):
+        self._children[index] = element
+
+    def __delitem__(self, index):
+        del self._children[index]
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def append(self, element):
+        self._children.append(element)
+
+    def insert(self, index, element):
+        self._children.insert(index, element)
+
+    def remove(self, element):
+        self._children.remove(element)
+
+    def getchildren(self):
+        return self._children
+
+    def find(self, path):
+        return ElementTree.ElementPath.find(self, path)
+
+    def findtext(self, path, default=None):
+        return ElementTree.ElementPath.findtext(self, path, default)
+
+    def findall(self, path):
+        return ElementTree.ElementPath.findall(self, path)
+
+    def clear(self):
+        self.attrib.clear()
+        self._children = []
+        self.text = self.tail = None
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def set(self, key, value):
+        self.attrib[key] = value
+
+    def keys(self):
+        return self.attrib.keys()
+
+    def items(self):
+        return self.attrib.items()
+
+    def getiterator(self, tag=None):
+        nodes = []
+        if tag == "*":
+            tag = None
+        if tag is None or self.tag == tag:
+            nodes.append(self)
+        for node in self._children:
+            nodes.extend(node.getiterator(tag))
+        return nodes
+
+    def iter(self, tag=None):
+        return iter(self.getiterator(tag))
+
+class ParentMap(object):
+    """A {child: parent} mapping view of a list of nodes with `parent`
+    pointers, for code written for a `nodemap` dict.
+    """
+    __slots__ = ("_nodes",)
+
+    def __init__(self, nodes):
+        self._nodes = nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __contains__(self, node):
+        return isinstance(node, HTMLElement)
+
+    def __getitem__(self, node):
+        if not isinstance(node, HTMLElement):
+            raise KeyError(node)
+        return node.parent
+
+    def __setitem__(self, node, parent):
+        node.parent = parent
+
+    def get(self, node, default=None):
+        if not isinstance(node, HTMLElement):
+            return default
+        return node.parent
+
+    def keys(self):
+        return list(self._nodes)
+
 class HTMLTreeBuilder(ElementTree.TreeBuilder):
 
     def __init__(self, encoding="iso-8859-1"):
-        ElementTree.TreeBuilder.__init__(self)
+        ElementTree.TreeBuilder.__init__(self, HTMLElement)
         self.encoding = encoding
         self.nodes = []
-        self.nodemap = {} # {child_elem: parent_elem, ... }
+        self.nodemap = ParentMap(self.nodes) # {child_elem: parent_elem, ... }
         self._rootnodes = []
         self.current = None
 
@@ -195,15 +353,10 @@ class HTMLTreeBuilder(ElementTree.TreeBuilder):
         ElementTree.TreeBuilder.start(self, tag, attrib)
         el = self._elem[-1]
         self.current = el
-        el.ns = None
-        el.localName = el.tag
         el.start = loc_start
-        el.end = None
         self.nodes.append(el)
         if len(self._elem) > 1:
-            self.nodemap[el] = self._elem[-2]
-        else:
-            self.nodemap[el] = None
+            el.parent = self._elem[-2]
         if l_tag in html_no_close_tags:
             self.end_tag(tag, loc_end)
 
@@ -273,8 +426,7 @@ class Parser:
         self.doctype = None
         self.publicId = None
         self.systemId = None
-        self.locator = {}
-        self._lastloc = None
+        self.lineIndex = None
         self.data = None
 
     def parse_doctype(self, data):
@@ -291,25 +443,29 @@ class Parser:
             self.systemId = strip_quotes(result['data1'])
 
     def getLocation(self, loc):
-        pos = 0
-        last_lines = 0
-        if self._lastloc:
-            pos = self._lastloc
-            last_lines = self.locator[pos][0]
-        lines = last_lines + self.data.count("\n",pos,loc)
-        col =  0
-        if lines > last_lines:
-            col = loc - self.data.rfind("\n",pos,loc) - 1
-        elif pos in self.locator:
-            col = loc - pos + self.locator[pos][1]
-        self.locator[loc] = [lines, col]
-        self._lastloc = loc
-        return (lines + 1, col, loc)
+        r"""Return the (1-based line, 0-based column, offset) of the given
+        offset in the data being parsed. Columns on the first line count
+        from the start of the data, like on the other lines:
+
+            >>> class StartsBuilder:
+            ...     def start(self, tag, attrs, loc_start, loc_end):
+            ...         print tag, loc_start, loc_end
+            ...     def end(self, tag, loc=None): pass
+            ...     def data(self, data): pass
+            ...     def close(self): pass
+            >>> Parser(StartsBuilder()).feed('  <p class="x"><b>bold</b></p>\n <i/>')
+            p (1, 2, 2) (1, 15, 15)
+            b (1, 15, 15) (1, 18, 18)
+            i (2, 1, 32) (2, 5, 36)
+        """
+        line, col = self.lineIndex.line_col_from_offset(loc)
+        return (line + 1, col, loc)
         
     def feed(self, data, markuponly=0):
         no_close_tag = []
         opt_close_tag = []
         self.data = data
+        self.lineIndex = LineIndex(data)
         for matchObj in parseiter(data, markuponly):
             x = matchObj.group(0)
             m = matchObj.groupdict()
@@ -368,6 +524,7 @@ try:
 
         def feed(self, data, markuponly=0):
             self.data = data
+            self.lineIndex = LineIndex(data)
             return self.__parser.feed(data)
 
         def close(self):
@@ -36,9 +36,17 @@
 
 import os
 from os.path import islink, realpath, join
+import re
 import shutil
 import sys
 
+try:
+    # The "scandir" package's `os.walk()` gets file types from the
+    # directory listing instead of stat'ing every entry.
+    from scandir import walk as _os_walk
+except ImportError:
+    _os_walk = os.walk
+
 # Modified recipe: paths_from_path_patterns (0.5)
 def should_include_path(path, includes=None, excludes=None, isRemotePath=False):
     """Return True iff the given path should be included."""
@@ -73,10 +81,37 @@ def should_include_path(path, includes=None, excludes=None, isRemotePath=False):
                 return False
     return True
 
+def regex_from_glob_patterns(patterns):
+    """Return a compiled regex matching a basename matching any of the
+    given glob patterns (with `fnmatch` semantics), or None if there are
+    no patterns.
+
+    Names must be normalized with `os.path.normcase()` before matching.
+    """
+    from fnmatch import translate
+    if not patterns:
+        return None
+    regexes = []
+    for pattern in patterns:
+        regex = translate(os.path.normcase(pattern))
+        if regex.endswith("(?ms)"):  # Python 2 appends the flags.
+            regex = regex[:-len("(?ms)")]
+        regexes.append("(?:%s)" % regex)
+    return re.compile('|'.join(regexes), re.DOTALL)
+
 def _walk_avoiding_cycles(top, topdown=True, onerror=None, followlinks=False,
                           includes=None, excludes=None):
     seen_rpaths = {top: 1}
-    for root, dirs, files in os.walk(top, topdown, onerror, followlinks):
+    # Compile the patterns once, rather than `should_include_path()`
+    # running `fnmatch()` for each pattern for each name.
+    include_re = regex_from_glob_patterns(includes)
+    exclude_re = regex_from_glob_patterns(excludes)
+    def include(name):
+        name = os.path.normcase(name)
+        if include_re is not None and not include_re.match(name):
+            return False
+        return exclude_re is None or not exclude_re.match(name)
+    for root, dirs, files in _os_walk(top, topdown, onerror, followlinks):
         # We modify the original "dirs" list, so that os.walk will then ignore
         # the directories we've removed.
         for dir in dirs[:]:  # a copy, so we can modify in-place.
@@ -90,8 +125,8 @@ def _walk_avoiding_cycles(top, topdown=True, onerror=None, followlinks=False,
                 seen_rpaths[rpath] = 1
         if includes or excludes:
             # The dirs must be modified in place (see comment above)!
-            dirs[:] = [dir for dir in dirs if should_include_path(dir, includes, excludes)]
-            files = [f for f in files if should_include_path(f, includes, excludes)]
+            dirs[:] = [dir for dir in dirs if include(dir)]
+            files = [f for f in files if include(f)]
         yield (root, dirs, files)
 
 def walk_avoiding_cycles(top, topdown=True, onerror=None, followlinks=False,
@@ -112,7 +147,7 @@ def walk_avoiding_cycles(top, topdown=True, onerror=None, followlinks=False,
         if includes or excludes:
             raise Exception("walk_avoiding_cycles can only use includes/excludes when "
                             "followlinks is True")
-        return os.walk(top, topdown, onerror, followlinks)
+        return _os_walk(top, topdown, onerror, followlinks)
     else:
         # Can only avoid cycles if topdown is True.
         if not topdown:
@@ -40,6 +40,7 @@ import re
 from koSimpleLexer import *
 from koDTD import DTD
 from koRNGElementTree import rng
+from koSchemaCache import SchemaCache
 
 log = logging.getLogger("koCatalog")
 #log.setLevel(logging.INFO)
@@ -78,12 +79,57 @@ a("double",        r'(?P<type>%(double_types)s)\s+(?P<data1>%(QuotedString)s|\S+
 a("COMMENT" ,       r"<!--(?P<comment>.*?)-->", re.S|re.M)
 a("newlines" ,                   "[ \t]*(\r\n|\r|\n)")
 
-def _cmpLen(a, b):
-    al = len(a)
-    bl = len(b)
-    if al>bl: return -1
-    if al==bl: return cmp(a, b)
-    return 1
+class PrefixTrie:
+    """Maps string prefixes to values. The prefixes of a string are looked
+    up in time linear in the length of the string.
+    """
+    def __init__(self, items=()):
+        # each node is a dict of the next characters to their nodes, a
+        # node's value is kept under the (never a character) "" key
+        self.root = {}
+        for prefix, value in items:
+            self[prefix] = value
+
+    def __setitem__(self, prefix, value):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[""] = value
+
+    def matches(self, s):
+        """Return the [(prefix, value), ...] of the prefixes of s, the
+        longest first.
+        """
+        node = self.root
+        result = []
+        if "" in node:
+            result.append(("", node[""]))
+        for i, c in enumerate(s):
+            node = node.get(c)
+            if node is None:
+                break
+            if "" in node:
+                result.append((s[:i+1], node[""]))
+        result.reverse()
+        return result
+
+    def longestMatch(self, s):
+        """Return the (prefix, value) of the longest prefix of s, or
+        None.
+        """
+        node = self.root
+        match = None
+        if "" in node:
+            match = (0, node[""])
+        for i, c in enumerate(s):
+            node = node.get(c)
+            if node is None:
+                break
+            if "" in node:
+                match = (i + 1, node[""])
+        if match is None:
+            return None
+        return s[:match[0]], match[1]
 
 def strip_quotes(str):
     if not str:
@@ -156,44 +202,49 @@ class Catalog:
 
         self.resolver = resolver
         self.parse()
+        self._buildPrefixTables()
+
+    def _buildPrefixTables(self):
+        # the rewrite and delegate entries are matched by prefix
+        self._rewritesystem = PrefixTrie(self.rewritesystem.items())
+        self._rewriteuri = PrefixTrie(self.rewriteuri.items())
+        self._delegatepublic = PrefixTrie(self.delegatepublic.items())
+        self._delegatesystem = PrefixTrie(self.delegatesystem.items())
+        self._delegateuri = PrefixTrie(self.delegateuri.items())
 
     # Support functions for matching data to a catalog
-    def _longestMatch(self, needle, haystack):
-        haystack.sort(_cmpLen)
-        for straw in haystack:
-            if needle.find(straw) == 0:
-                return straw
-        return None
-    
-    def _getRewrite(self, id, ar):
-        possible = self._longestMatch(id, ar.keys())
-        if possible:
-            return "%s%s" % (ar[possible],id[len(possible):])
+    def _getRewrite(self, id, trie):
+        # the longest matching start string is used
+        match = trie.longestMatch(id)
+        if match and match[0]:
+            return "%s%s" % (match[1], id[len(match[0]):])
         return None
 
-    def _getDelegates(self, id, delegates):
-        if id not in delegates:
-            return None
-        entries = delegates[id].keys().sort(_cmpLen)
-        return [delegates[id][d].catalog for d in entries]
+    def _getDelegates(self, id, trie):
+        # the catalogs of all matching start strings, ordered by the length
+        # of the start string, longest first, and in document order
+        catalogs = []
+        for prefix, delegates in trie.matches(id):
+            catalogs.extend([d.catalog for d in delegates])
+        return catalogs or None
 
     def getSystemRewrite(self, systemId):
-        return self._getRewrite(systemId, self.rewritesystem)
+        return self._getRewrite(systemId, self._rewritesystem)
 
     def getURIRewrite(self, uri):
-        return self._getRewrite(uri, self.rewriteuri)
+        return self._getRewrite(uri, self._rewriteuri)
 
     def getSystemDelegates(self, systemId):
         # 7.1.2 #4
-        return self._getDelegates(systemId, self.delegatesystem)
+        return self._getDelegates(systemId, self._delegatesystem)
 
     def getPublicDelegates(self, publicId):
         # 7.1.2 #6 
-        return self._getDelegates(publicId, self.delegatepublic)
+        return self._getDelegates(publicId, self._delegatepublic)
 
     def getURIDelegates(self, uri):
         # 7.1.2 #6 
-        return self._getDelegates(uri, self.delegateuri)
+        return self._getDelegates(uri, self._delegateuri)
 
 class NamespaceParser(XMLTreeBuilder):
     _qname = re.compile("{(.*?)}(.*)")
@@ -263,13 +314,15 @@ class XMLCatalog(Catalog):
         startId = node.attrib.get("publicIdStartString")
         if startId not in self.delegatepublic:
             self.delegatepublic[startId] = []
-        self.delegatepublic[startId].append(Delegate(node=node))
+        catalogURI = self._get_relative_uri(node.attrib.get('catalog'), node)
+        self.delegatepublic[startId].append(Delegate(catalogURI, node))
         
     def _handle_delegatesystem(self, node):
         startId = node.attrib.get("systemIdStartString")
         if startId not in self.delegatesystem:
             self.delegatesystem[startId] = []
-        self.delegatesystem[startId].append(Delegate(node=node))
+        catalogURI = self._get_relative_uri(node.attrib.get('catalog'), node)
+        self.delegatesystem[startId].append(Delegate(catalogURI, node))
         
     def _handle_uri(self, node):
         name = node.attrib.get("name")
@@ -283,7 +336,8 @@ class XMLCatalog(Catalog):
         startId = node.attrib.get("uriStartString")
         if startId not in self.delegateuri:
             self.delegateuri[startId] = []
-        self.delegateuri[startId].append(Delegate(node=node))
+        catalogURI = self._get_relative_uri(node.attrib.get('catalog'), node)
+        self.delegateuri[startId].append(Delegate(catalogURI, node))
         
     def _handle_nextcatalog(self, node):
         catalogURI = self._get_relative_uri(node.attrib.get('catalog'), node)
@@ -393,7 +447,8 @@ class SGMLCatalog(Catalog):
             filename = relativize(self.dir, data2)
             self.system[data1] = SystemID(data1, filename)
         elif m['type'] == "DELEGATE":
-            self.delegatepublic[data1] = Delegate(data1, data2)
+            catalogURI = relativize(self.dir, data2)
+            self.delegatepublic.setdefault(data1, []).append(Delegate(catalogURI))
         elif m['type'] == "CATALOG":
             self.nextcatalog.append(data1)
             if self.resolver:
@@ -412,7 +467,12 @@ class CatalogResolver:
         '+': ' ', ':': '//', ';': '::', '%2B': '+', '%3A': ':',
         '%2F': '/', '%3B': ';', '%27': "'", '%3F': '?', '%23': '#', '%25': '%'
     }
-    def __init__(self, catalogURIs=[]):
+    def __init__(self, catalogURIs=[], cacheDir=None):
+        # datasets built from schema files are kept in cacheDir, if given,
+        # across processes
+        self.schemaCache = None
+        if cacheDir:
+            self.schemaCache = SchemaCache(cacheDir)
         self.init(catalogURIs)
 
     def init(self, catalogURIs=[]):
@@ -423,9 +483,15 @@ class CatalogResolver:
         self.catalogs = []
         self.catalogMap = {}
         self.datasets = {} # uri to dataset map
+        # resolved identifiers and uris, including those that did not
+        # resolve (None), kept until the catalogs change
+        self._resolved = {}
+        self.hits = 0
+        self.misses = 0
         self.resetCatalogs(catalogURIs)
     
     def resetCatalogs(self, catalogURIs=[]):
+        self._resolved.clear()
         catalogs = []
         for uri in catalogURIs:
             try:
@@ -443,6 +509,7 @@ class CatalogResolver:
         if uri in self.catalogMap:
             log.info("Catalog already parsed [%s]", uri)
             return None
+        self._resolved.clear()
         # XXX how do we determin what type of catalog we want to open?
         ext = os.path.splitext(uri)[1]
         if ext == ".xml":
@@ -453,6 +520,37 @@ class CatalogResolver:
         self.catalogMap[uri] = catalog
         return catalog
 
+    def _memoized(self, key, resolve, *args):
+        if key in self._resolved:
+            self.hits += 1
+            return self._resolved[key]
+        self.misses += 1
+        result = resolve(*args)
+        self._resolved[key] = result
+        return result
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._resolved),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": lookups and float(self.hits) / lookups or 0.0,
+        }
+
+    def _getCatalogs(self, catalogURIs):
+        # delegate catalogs are only read when they are first needed
+        catalogs = []
+        for uri in catalogURIs:
+            if uri not in self.catalogMap:
+                try:
+                    self.addCatalogURI(uri)
+                except Exception, e:
+                    log.error("Unable to read catalog file [%s] [%s]", uri, e)
+                    continue
+            catalogs.append(self.catalogMap[uri])
+        return catalogs
+
     def unwrapURN(self, urn):
         # http://www.oasis-open.org/committees/entity/spec.html#s.xmlcat
         # 6.4. URN "Unwrapping"
@@ -482,7 +580,7 @@ class CatalogResolver:
             # 7.1.2 #4
             delegatecatalogs = catalog.getSystemDelegates(systemId)
             if delegatecatalogs:
-                return self.findExternalIdentifier(delegatecatalogs, None, systemId)
+                return self.findExternalIdentifier(self._getCatalogs(delegatecatalogs), None, systemId)
         # 7.1.2 #5
         if publicId:
             if publicId in catalog.public:
@@ -490,7 +588,7 @@ class CatalogResolver:
             # 7.1.2 #6 
             delegatecatalogs = catalog.getPublicDelegates(publicId)
             if delegatecatalogs:
-                return self.findExternalIdentifier(delegatecatalogs, publicId, None)
+                return self.findExternalIdentifier(self._getCatalogs(delegatecatalogs), publicId, None)
         for catalogURI in catalog.nextcatalog:
             ident = self.findExternalIdentifierInCatalog(self.catalogMap[catalogURI], publicId, systemId)
             if ident:
@@ -512,7 +610,11 @@ class CatalogResolver:
         # resolve the dataset declaration to a uri
         if not publicId and not systemId:
             raise "no public or system id provided to the resolver"
+        return self._memoized(("id", publicId, systemId),
+                              self._resolveExternalIdentifier,
+                              publicId, systemId)
 
+    def _resolveExternalIdentifier(self, publicId, systemId):
         if publicId:
             if publicId.find('urn:publicid:') == 0:
                 publicId = self.unwrapURN(publicId)
@@ -536,7 +638,7 @@ class CatalogResolver:
             return rewrite
         delegatecatalogs = catalog.getURIDelegates(uri)
         if delegatecatalogs:
-            return self.findURI(delegatecatalogs, uri)
+            return self.findURI(self._getCatalogs(delegatecatalogs), uri)
         for catalogURI in catalog.nextcatalog:
             ident = self.findURIInCatalog(self.catalogMap[catalogURI], uri)
             if ident:
@@ -553,6 +655,9 @@ class CatalogResolver:
 
     # e.g. an XML namespace
     def resolveURI(self, uri):
+        return self._memoized(("uri", uri), self._resolveURI, uri)
+
+    def _resolveURI(self, uri):
         # 7.2.1
         if uri.find('urn:publicid:') == 0:
             uri = self.unwrapURN(uri)
@@ -568,6 +673,11 @@ class CatalogResolver:
     def getDatasetForURI(self, uri, casename=False):
         if uri in self.datasets:
             return self.datasets[uri]
+        if self.schemaCache is not None:
+            dataset = self.schemaCache.load(uri, casename, self)
+            if dataset is not None:
+                self.datasets[uri] = dataset
+                return dataset
         ext = os.path.splitext(uri)[1]
         if ext == ".dtd":
             dataset = DTD(uri, resolver=self, casename=casename).dataset
@@ -576,6 +686,8 @@ class CatalogResolver:
         else:
             raise "Unsuported Scheme type (DTD and RelaxNG only)"
         self.datasets[uri] = dataset
+        if self.schemaCache is not None:
+            self.schemaCache.save(uri, dataset, casename, self)
         return dataset
 
     def getDatasetForDoctype(self, publicId=None, systemId=None):
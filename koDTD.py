@@ -38,7 +38,9 @@ import os
 import logging
 import re
 import weakref
+from bisect import bisect_right
 from koSimpleLexer import *
+from textutils import LineIndex
 
 log = logging.getLogger("koDTD")
 #log.setLevel(logging.DEBUG)
@@ -89,14 +91,40 @@ a("ENTITY",         r'<!ENTITY\s+(?P<name>\S+)\s+(?P<content>%(QuotedString)s)\s
 #   <?doc type="doctype" role="title" { XHTML 1.1 } ?>
 a("PROCTAG" ,       r"<\?.*?\?>", re.S|re.M)
 
+# used for parameter entity expansion
+a("PEReferenceName" , r"%%(?P<name>[\w.:-]+);?", re.U)
+a("nameChars" ,     r"[\w.:;-]*", re.U)
+a("ignoreStart" ,   r'<!\[\s*IGNORE\s*\[', re.S)
+
+def resolveExternalEntity(base, publicId, systemId, resolver=None):
+    """Return the path of the file for an external parameter entity
+    referenced from a DTD in the base dir, or None if there is none.
+    """
+    filename = relativize(base, systemId)
+    if not os.path.exists(filename):
+        if resolver:
+            filename = resolver.resolveURI(filename)
+            if not filename or not os.path.exists(filename):
+                filename = resolver.resolveExternalIdentifier(publicId, systemId)
+    if filename and os.path.exists(filename):
+        return filename
+    return None
+
 class dtd_dataset:
     def __init__(self):
         self.entities = {}
+        # {name: replacement text} of the internal parameter entities, the
+        # first declaration wins
+        self.pe_text = {}
         self.elements = {}
         self.root = []
         self.attlist = {}
         self.namespace = ""
         self.elements_caseless = {}
+        self.sources = [] # the files parsed into this dataset
+        # external entities that could not be resolved, [(base dir,
+        # publicId, systemId), ...]
+        self.unresolved = []
 
     def element_info(self, element_name):
         name = element_name.lower()
@@ -105,17 +133,10 @@ class dtd_dataset:
         return None
 
     def buildRootList(self):
-        all_elements = self.elements.keys()
-        root = {}
-        for el in all_elements:
-            found = 0
-            for e in self.elements.values():
-                if el in e.elements:
-                    found = 1
-                    break
-            if not found:
-                root[el] = 1
-        self.root = root.keys()
+        children = set()
+        for e in self.elements.values():
+            children.update(e.elements)
+        self.root = [el for el in self.elements if el not in children]
 
     def possible_children(self, element_name=None):
         if not element_name:
@@ -175,7 +196,13 @@ class dtd_entity:
             self.entity = None
             self.dtd = None
         self.content = strip_quotes(d['content'])
-        self.entityRe = re.compile(r"%%%s\b;?" % self.name, re.U)
+        self._entityRe = None
+
+    @property
+    def entityRe(self):
+        if self._entityRe is None:
+            self._entityRe = re.compile(r"%%%s\b;?" % self.name, re.U)
+        return self._entityRe
 
     def applyEntity(self, text):
         if self.type is None:
@@ -256,6 +283,9 @@ class dtd_attr:
 
 
 
+def _commentNewlines(m):
+    return "".join(collector.res["newlines"].findall(m.group(0)))
+
 class DTD:
 
     # states
@@ -294,6 +324,7 @@ class DTD:
         if dataset is None:
             dataset = dtd_dataset()
         self.dataset = dataset
+        self.dataset.sources.append(filename)
         self._element_stack = [self.dataset]
         self._includes = []
         self.filename = filename
@@ -301,6 +332,13 @@ class DTD:
         self.parse()
         self.dataset.buildRootList()
 
+    # Parameter entity references are expanded lazily, in a buffer that
+    # the lexer scans and that is refilled from the source text as the
+    # lexer reaches its end. See _fill(). A DTD without references is
+    # scanned directly.
+    bufferChunk = 64 * 1024
+    bufferMargin = 4 * 1024
+
     def parse(self):
         # setup lexer and add token matching regexes
         self.l = Lexer(self.filename)
@@ -309,6 +347,8 @@ class DTD:
             attributes = p[2]
             if not attributes: attributes = MAPTOK|EXECFN
             self.l.addmatch(collector.res[p[0]],p[1],p[0],attributes)
+        # report syntax errors at source lines
+        self.l.lineno = self.sourceLineno
 
         self.currentTag = None
         self.lineno = 1
@@ -324,23 +364,242 @@ class DTD:
         # XXX
         # because of the many issues around comments in dtd files, and since
         # we're doing a sloppy parse, lets just get rid of all comments now.
-        data = collector.res["COMMENT"].sub("", data)
+        # Their newlines are kept so that line numbers stay right.
+        data = collector.res["COMMENT"].sub(_commentNewlines, data)
         r = re.compile(r"--.*?--", re.S|re.U)
-        data = r.sub("", data)
+        data = r.sub(_commentNewlines, data)
         
-        data = self.applyEntities(data)
+        self._src = data
+        self._srclines = LineIndex(data)
+        # buffer segments: [buffer offsets], [(source offset, is source
+        # text?), ...], an expanded entity maps to its reference's offset
+        self._segstarts = [0]
+        self._segsrc = [(0, True)]
+        if collector.res["PEReferenceName"].search(data):
+            self._srcpos = 0
+            self.l.settext("")
+        else:
+            # nothing to expand
+            self._srcpos = len(data)
+            self.l.settext(data)
         
-        self.l.settext(data)
-            
         #res = []
         while 1:
-            t, v = self.l.scan()
+            self._fill()
+            self.lineno = self.sourceLineno()
+            textindex = self.l.textindex
+            try:
+                t, v = self.l.scan()
+            except Exception:
+                if self.l.textindex != textindex or self._srcpos >= len(self._src):
+                    raise
+                # no token matched, it may be longer than the buffer
+                self._refill(max(len(self.l.text) - textindex, self.bufferChunk))
+                continue
             #if t and v:
             #    log.debug("  lex symbol: %r %r", t, v)
             if t == self.l.eof:
                 break
             #res.append((t, v))
 
+    def sourceLineno(self, textindex=None):
+        """Return the 1-based line in the DTD file of the given (by
+        default the current) lexer text index. Text from expanded entities
+        is at the line of the entity reference.
+        """
+        if textindex is None:
+            textindex = self.l.textindex
+        i = bisect_right(self._segstarts, textindex) - 1
+        offset, isSource = self._segsrc[i]
+        if isSource:
+            offset += textindex - self._segstarts[i]
+        return self._srclines.line_col_from_offset(offset)[0] + 1
+
+    def _fill(self):
+        """Make sure the lexer text has `bufferMargin` chars past the
+        lexer position, and all of an IGNORE section that starts there,
+        expanding the next chunks of the source text as needed. Longer
+        tokens fail to match and scanData() refills and retries.
+        """
+        l = self.l
+        while self._srcpos < len(self._src):
+            ahead = len(l.text) - l.textindex
+            if ahead < self.bufferMargin:
+                self._refill(self.bufferMargin + self.bufferChunk - ahead)
+            elif collector.res["ignoreStart"].match(l.text, l.textindex) \
+                 and l.text.find("]]>", l.textindex) == -1:
+                self._refill(ahead)
+            else:
+                break
+
+    def _refill(self, size):
+        # drop the scanned text and expand `size` more source chars
+        l = self.l
+        src = self._src
+        end = min(self._srcpos + size, len(src))
+        # don't split a reference
+        end = collector.res["nameChars"].match(src, end).end()
+        pieces = []
+        self._expand(src[self._srcpos:end], self._srcpos, True, pieces, [])
+        self._srcpos = end
+        self._splice(len(l.text), pieces)
+
+    def _splice(self, start, pieces):
+        """Drop the scanned lexer text and replace the text from `start`
+        on with the pieces, [(text, source offset, is source text?), ...].
+        The segments before `start` are kept as they are.
+        """
+        l = self.l
+        textindex = l.textindex
+        segstarts = self._segstarts
+        segsrc = self._segsrc
+        self._segstarts = newstarts = []
+        self._segsrc = newsrc = []
+        i = bisect_right(segstarts, textindex) - 1
+        while i < len(segstarts) and segstarts[i] < start:
+            segstart = max(segstarts[i], textindex)
+            offset, isSource = segsrc[i]
+            if isSource:
+                offset += segstart - segstarts[i]
+            newstarts.append(segstart - textindex)
+            newsrc.append((offset, isSource))
+            i += 1
+        pos = start - textindex
+        for text, offset, isSource in pieces:
+            if text:
+                newstarts.append(pos)
+                newsrc.append((offset, isSource))
+                pos += len(text)
+        if not newstarts:
+            newstarts.append(0)
+            newsrc.append((self._srcpos, True))
+        l.settext(l.text[textindex:start] + "".join([p[0] for p in pieces]))
+
+    def _segments(self, start, end):
+        """Return the lexer text from start to end as pieces."""
+        text = self.l.text
+        segstarts = self._segstarts
+        pieces = []
+        i = bisect_right(segstarts, start) - 1
+        while i < len(segstarts) and segstarts[i] < end:
+            segstart = max(segstarts[i], start)
+            if i + 1 < len(segstarts):
+                segend = min(segstarts[i+1], end)
+            else:
+                segend = end
+            if segend > segstart:
+                offset, isSource = self._segsrc[i]
+                if isSource:
+                    offset += segstart - segstarts[i]
+                pieces.append((text[segstart:segend], offset, isSource))
+            i += 1
+        return pieces
+
+    def _expand(self, text, offset, isSource, pieces, active):
+        """Append the text to the pieces with the references to known
+        parameter entities replaced by their (expanded) text. `active` are
+        the entities being expanded, which are not expanded again.
+        """
+        pe_text = self.dataset.pe_text
+        pos = 0
+        for m in collector.res["PEReferenceName"].finditer(text):
+            name = m.group('name')
+            if name not in pe_text or name in active:
+                continue
+            start = m.start()
+            if start > pos:
+                if isSource:
+                    pieces.append((text[pos:start], offset + pos, True))
+                else:
+                    pieces.append((text[pos:start], offset, False))
+            if isSource:
+                refoffset = offset + start
+            else:
+                refoffset = offset
+            active.append(name)
+            self._expand(pe_text[name], refoffset, False, pieces, active)
+            active.pop()
+            pos = m.end()
+        if pos < len(text):
+            if isSource:
+                pieces.append((text[pos:], offset + pos, True))
+            else:
+                pieces.append((text[pos:], offset, False))
+
+    def _reexpand(self, name=None):
+        """Expand the references to the given (by default all) new
+        entities in the unscanned lexer text.
+        """
+        l = self.l
+        if name is None:
+            pieces = []
+            for text, offset, isSource in self._segments(l.textindex, len(l.text)):
+                self._expand(text, offset, isSource, pieces, [])
+            self._splice(l.textindex, pieces)
+            return
+        text = l.text
+        textindex = l.textindex
+        ref = "%" + name
+        start = text.find(ref, textindex)
+        if start == -1:
+            return
+        # splice the expansion in at each reference, the segments in
+        # between are copied as they are
+        segstarts = self._segstarts
+        segsrc = self._segsrc
+        newstarts = []
+        newsrc = []
+        parts = []
+        pos = 0 # text copied up to here
+        i = 0 # segments copied up to here
+        delta = 0 # shift of the text after pos
+        # expanded text is mapped to the reference, whatever it contains
+        expansion = []
+        self._expand(self.dataset.pe_text[name], 0, False, expansion, [name])
+        expansion = [piece[0] for piece in expansion]
+        refRe = collector.res["PEReferenceName"]
+        while start != -1:
+            m = refRe.match(text, start)
+            if m.group('name') != name:
+                start = text.find(ref, start + 1)
+                continue
+            end = m.end()
+            j = bisect_right(segstarts, start) - 1
+            newstarts.extend([s + delta for s in segstarts[i:j+1]])
+            newsrc.extend(segsrc[i:j+1])
+            parts.append(text[pos:start])
+            offset, isSource = segsrc[j]
+            if isSource:
+                offset += start - segstarts[j]
+            newpos = start + delta
+            for piece in expansion:
+                newstarts.append(newpos)
+                newsrc.append((offset, False))
+                parts.append(piece)
+                newpos += len(piece)
+            delta = newpos - end
+            pos = end
+            # the rest of the segment the reference ends in
+            k = bisect_right(segstarts, end) - 1
+            if segstarts[k] == end:
+                i = k
+            else:
+                i = k + 1
+                if end < len(text):
+                    offset, isSource = segsrc[k]
+                    if isSource:
+                        offset += end - segstarts[k]
+                    newstarts.append(end + delta)
+                    newsrc.append((offset, isSource))
+            start = text.find(ref, end)
+        newstarts.extend([s + delta for s in segstarts[i:]])
+        newsrc.extend(segsrc[i:])
+        parts.append(text[pos:])
+        self._segstarts = newstarts
+        self._segsrc = newsrc
+        l.settext("".join(parts))
+        l.textindex = textindex
+
     def applyEntities(self, text):
         # apply all existing entities to this text
         for e in self.dataset.entities.values():
@@ -384,11 +643,11 @@ class DTD:
         self.doMultiLineBlock(m)
         t = dtd_entity(m.groupdict())
         self.dataset.entities[m.group('name')] = t
-        # if this is a peentity, we want to replace text with the entity content
-        # we know it is a peentity if there the type is None
-        if t.type is None:
-            text = t.applyEntity(self.l.text[self.l.textindex:])
-            self.l.text = self.l.text[:self.l.textindex-1] + text
+        # if this is a peentity, we want to replace its references with the
+        # entity content, we know it is a peentity if there the type is None
+        if t.type is None and t.name not in self.dataset.pe_text:
+            self.dataset.pe_text[t.name] = t.content or ""
+            self._reexpand(t.name)
         return ""
         
     def pereference(self, m):
@@ -397,21 +656,17 @@ class DTD:
         if self.ignore: return ""
         entity = self.dataset.entities[m.group('ref')]
         if entity.dtd:
-            filename = relativize(os.path.dirname(self.filename),entity.dtd)
-
-            if not os.path.exists(filename):
-                if self.resolver:
-                    filename = self.resolver.resolveURI(filename)
-                    if not filename or not os.path.exists(filename):
-                        filename = self.resolver.resolveExternalIdentifier(entity.entity, entity.dtd)
-
-            if filename and os.path.exists(filename):
+            base = os.path.dirname(self.filename)
+            filename = resolveExternalEntity(base, entity.entity, entity.dtd,
+                                             self.resolver)
+            if filename:
                 #log.info("    parsing [%s]", filename)
                 d = DTD(filename, self.dataset, self.resolver)
-                text = self.applyEntities(self.l.text[self.l.textindex:])
-                self.l.text = self.l.text[:self.l.textindex-1] + text
+                # expand the entities it declared
+                self._reexpand()
             else:
-                log.warn("UNRESOLVED REFERENCE [%s][%s][%s][%s]", m.group('ref'), entity.type, entity.entity, filename)
+                self.dataset.unresolved.append((base, entity.entity, entity.dtd))
+                log.warn("UNRESOLVED REFERENCE [%s][%s][%s][%s]", m.group('ref'), entity.type, entity.entity, entity.dtd)
         else:
             # XXX we need catalog support to do this
             log.warn("UNRESOLVED REFERENCE [%s][%s][%s]", m.group('ref'), entity.type, entity.entity)
@@ -94,6 +94,7 @@ class rng_dataset(rng_base_dataset):
         self.namespace = ""
         self.datatypeLibrary = ""
         self.xmlns = ""
+        self.sources = [] # the files parsed into this dataset
 
         self.ref_resolving = {}
         self.ref_unresolved = {}
@@ -176,16 +177,22 @@ class rng_dataset(rng_base_dataset):
         print "-"*60
 
 class rng_node_info(rng_base_dataset):
-    def __init__(self, node):
+    def __init__(self, node=None, name=None):
         rng_base_dataset.__init__(self)
-        self.name = node.attrib.get("name")
+        # nodes loaded from the schema cache have no element tree node
+        if node is not None:
+            name = node.attrib.get("name")
+        self.name = name
         self._node = node
 
 class element_info(rng_node_info):
     def dump(self, stream):
         attrs = []
-        for n,v in self._node.attrib.items():
-            attrs.append('%s="%s"' % (n, v))
+        if self._node is not None:
+            for n,v in self._node.attrib.items():
+                attrs.append('%s="%s"' % (n, v))
+        else:
+            attrs.append('name="%s"' % self.name)
         stream.write("<element %s>\n" % ' '.join(attrs))
         names = [el.name for el in self.elements]
         stream.write("    children %r\n" % names)
@@ -218,6 +225,7 @@ class rng:
         if dataset is None:
             dataset = rng_dataset()
         self.dataset = dataset
+        self.dataset.sources.append(filename)
         self._element_stack = [self.dataset]
         self._includes = []
         self.filename = filename
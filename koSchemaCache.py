@@ -0,0 +1,392 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+# 
+# The contents of this file are subject to the Mozilla Public License
+# Version 1.1 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+# 
+# Software distributed under the License is distributed on an "AS IS"
+# basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See the
+# License for the specific language governing rights and limitations
+# under the License.
+# 
+# The Original Code is Komodo code.
+# 
+# The Initial Developer of the Original Code is ActiveState Software Inc.
+# Portions created by ActiveState Software Inc are Copyright (C) 2000-2007
+# ActiveState Software Inc. All Rights Reserved.
+# 
+# Contributor(s):
+#   ActiveState Software Inc
+# 
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+# 
+# ***** END LICENSE BLOCK *****
+
+
+"""
+koSchemaCache keeps the datasets built from DTD and RelaxNG schemas on disk
+so that a new process does not have to parse the schema files again.
+
+A cache file is keyed by the schema path (and the casename flag used for
+HTML DTDs) and records the modification time and md5 hash of every file
+that was parsed into the dataset, including those pulled in through
+parameter entity references and RelaxNG includes. It also records the
+catalogs the resolver used and the external entities that could not be
+resolved: the cache is out of date when the catalogs change or one of
+those entities now resolves. The elements are stored as separate pickles
+that are only unpickled when first queried.
+
+File layout, all integers are 4 byte little endian:
+
+    "koSchemaCache <FORMAT_VERSION>\n"
+    <header length> <header pickle: uri, casename, [(path, mtime, md5), ...],
+                     catalogs, unresolved entities>
+    <summary length> <summary pickle: kind, dataset fields, element maps,
+                      record offsets>
+    <element record pickles>
+"""
+
+import os
+import mmap
+import struct
+import logging
+import cPickle
+from hashlib import md5
+from UserDict import DictMixin
+
+from koDTD import dtd_dataset, resolveExternalEntity
+from koRNGElementTree import rng_dataset, element_info, attribute_info
+
+log = logging.getLogger("koSchemaCache")
+#log.setLevel(logging.DEBUG)
+
+# Bump this when the dataset classes or the layout change, older cache files
+# are then ignored and rewritten.
+FORMAT_VERSION = 2
+MAGIC = "koSchemaCache %d\n" % FORMAT_VERSION
+
+_length = struct.Struct("<I")
+_hashChunkSize = 64 * 1024
+
+def _fileHash(path):
+    hash = md5()
+    f = open(path, "rb")
+    try:
+        while 1:
+            chunk = f.read(_hashChunkSize)
+            if not chunk:
+                break
+            hash.update(chunk)
+    finally:
+        f.close()
+    return hash.hexdigest()
+
+def _readBlock(f):
+    size = f.read(_length.size)
+    if len(size) != _length.size:
+        raise IOError("truncated schema cache file")
+    size = _length.unpack(size)[0]
+    data = f.read(size)
+    if len(data) != size:
+        raise IOError("truncated schema cache file")
+    return cPickle.loads(data)
+
+def _writeBlock(f, obj):
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    f.write(_length.pack(len(data)))
+    f.write(data)
+
+
+class _RecordReader:
+    """Unpickles the element records of a cache file on demand.
+
+    `data` is the cache file mapped into memory (or a string), the records
+    start at `base`. The mapping is closed once all records are loaded.
+    """
+    def __init__(self, data, offsets, unpack=None, base=0):
+        self.data = data
+        self.offsets = offsets
+        self.unpack = unpack
+        self.base = base
+        self.records = {}
+
+    def record(self, index):
+        if index in self.records:
+            return self.records[index]
+        start = self.base + self.offsets[index]
+        end = self.base + self.offsets[index+1]
+        value = cPickle.loads(self.data[start:end])
+        if self.unpack:
+            value = self.unpack(value)
+        self.records[index] = value
+        if len(self.records) == len(self.offsets) - 1:
+            self.close()
+        return value
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+
+class _LazyMap(DictMixin):
+    """A dictionary of element names to records that are loaded the first
+    time they are looked up. Items set later are kept as they are.
+    """
+    def __init__(self, reader, index):
+        self._reader = reader
+        self._index = index # {key: record index}
+        self._items = {}
+
+    def __getitem__(self, key):
+        if key in self._items:
+            return self._items[key]
+        value = self._reader.record(self._index[key])
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._index.setdefault(key, None)
+        self._items[key] = value
+
+    def __delitem__(self, key):
+        del self._index[key]
+        self._items.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._index
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+
+# dataset packing, each kind is packed into (fields, maps, records) where
+# maps are {dataset attribute: {key: record index}}
+
+_dtdFields = ("entities", "pe_text", "root", "attlist", "namespace", "sources",
+              "unresolved")
+
+def _packDTD(dataset):
+    records = []
+    indexOf = {}
+    maps = {}
+    for attr in ("elements", "elements_caseless"):
+        index = maps[attr] = {}
+        for name, el in getattr(dataset, attr).items():
+            if id(el) not in indexOf:
+                indexOf[id(el)] = len(records)
+                records.append(el)
+            index[name] = indexOf[id(el)]
+    fields = dict((f, getattr(dataset, f)) for f in _dtdFields)
+    return fields, maps, records
+
+def _unpackDTD(fields, maps, reader):
+    dataset = dtd_dataset()
+    for f, value in fields.items():
+        setattr(dataset, f, value)
+    for attr, index in maps.items():
+        setattr(dataset, attr, _LazyMap(reader, index))
+    return dataset
+
+# only what the queries use is kept of the RelaxNG nodes, child elements
+# and attributes are reduced to their names and values
+_rngFields = ("name", "namespace", "datatypeLibrary", "xmlns", "sources")
+
+def _packRNGNode(node):
+    return (node.__class__ is attribute_info, node.name,
+            [el.name for el in node.elements],
+            [(a.name, a.values) for a in node.attributes],
+            node.values)
+
+def _unpackRNGNode(record):
+    isAttribute, name, elements, attributes, values = record
+    if isAttribute:
+        node = attribute_info(name=name)
+    else:
+        node = element_info(name=name)
+    node.elements = [element_info(name=n) for n in elements]
+    for n, v in attributes:
+        a = attribute_info(name=n)
+        a.values = v
+        node.attributes.append(a)
+    node.values = values
+    return node
+
+def _packRNG(dataset):
+    records = []
+    indexOf = {}
+    maps = {}
+    for attr in ("all_elements", "elements_caseless"):
+        index = maps[attr] = {}
+        for name, el in getattr(dataset, attr).items():
+            if id(el) not in indexOf:
+                indexOf[id(el)] = len(records)
+                records.append(_packRNGNode(el))
+            index[name] = indexOf[id(el)]
+    fields = dict((f, getattr(dataset, f)) for f in _rngFields)
+    fields["_root"] = _packRNGNode(dataset)
+    return fields, maps, records
+
+def _unpackRNG(fields, maps, reader):
+    dataset = rng_dataset()
+    fields = fields.copy()
+    root = _unpackRNGNode(fields.pop("_root"))
+    dataset.elements = root.elements
+    dataset.attributes = root.attributes
+    dataset.values = root.values
+    for f, value in fields.items():
+        setattr(dataset, f, value)
+    for attr, index in maps.items():
+        setattr(dataset, attr, _LazyMap(reader, index))
+    return dataset
+
+_kinds = {
+    # kind: (dataset class, pack, unpack, record unpack)
+    "dtd": (dtd_dataset, _packDTD, _unpackDTD, None),
+    "rng": (rng_dataset, _packRNG, _unpackRNG, _unpackRNGNode),
+}
+
+
+class SchemaCache:
+    """An on-disk cache of schema datasets, see the module docstring."""
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    def cacheFile(self, uri, casename=False):
+        key = "%s\0%d" % (os.path.abspath(uri), bool(casename))
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return os.path.join(self.cacheDir, md5(key).hexdigest() + ".schema")
+
+    def _catalogURIs(self, resolver):
+        if resolver is None:
+            return []
+        return [c.uri for c in resolver.catalogs]
+
+    def _isCurrent(self, header, uri, casename, resolver):
+        if header.get("uri") != uri or header.get("casename") != bool(casename):
+            return False
+        if header.get("catalogs") != self._catalogURIs(resolver):
+            log.debug("schema cache for [%s] is out of date, catalogs changed", uri)
+            return False
+        for base, publicId, systemId in header.get("unresolved", ()):
+            if resolveExternalEntity(base, publicId, systemId, resolver):
+                log.debug("schema cache for [%s] is out of date, [%s] now resolves",
+                          uri, systemId)
+                return False
+        for path, mtime, digest in header["sources"]:
+            try:
+                if os.stat(path).st_mtime == mtime:
+                    continue
+                if _fileHash(path) == digest:
+                    continue
+            except (IOError, OSError):
+                pass
+            log.debug("schema cache for [%s] is out of date, [%s] changed", uri, path)
+            return False
+        return True
+
+    def load(self, uri, casename=False, resolver=None):
+        """Return the cached dataset for the schema or None if there is
+        no current cache file for it. `resolver` is the CatalogResolver
+        the dataset would be built with.
+        """
+        path = self.cacheFile(uri, casename)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                if f.readline() != MAGIC:
+                    return None
+                if not self._isCurrent(_readBlock(f), uri, casename, resolver):
+                    return None
+                kind, fields, maps, offsets = _readBlock(f)
+                datasetClass, pack, unpack, unpackRecord = _kinds[kind]
+                # Map the records instead of reading them, most are never
+                # looked up. A newer cache file replaces this one by
+                # renaming, which leaves the mapping alone.
+                base = f.tell()
+                if os.fstat(f.fileno()).st_size - base != offsets[-1]:
+                    raise IOError("truncated schema cache file")
+                if offsets[-1]:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = ""
+                reader = _RecordReader(data, offsets, unpackRecord, base)
+                log.info("loaded schema cache for [%s]", uri)
+                return unpack(fields, maps, reader)
+            except Exception, e:
+                log.warn("Unable to read schema cache file [%s] [%s]", path, e)
+                return None
+        finally:
+            f.close()
+
+    def save(self, uri, dataset, casename=False, resolver=None):
+        """Write the dataset built from the schema to the cache."""
+        for kind, (datasetClass, pack, unpack, unpackRecord) in _kinds.items():
+            if isinstance(dataset, datasetClass):
+                break
+        else:
+            return
+        sources = []
+        for source in dataset.sources or [uri]:
+            try:
+                sources.append((source, os.stat(source).st_mtime,
+                                _fileHash(source)))
+            except (IOError, OSError), e:
+                log.debug("not caching schema [%s], [%s] %s", uri, source, e)
+                return
+        header = {"uri": uri, "casename": bool(casename), "sources": sources,
+                  "catalogs": self._catalogURIs(resolver),
+                  "unresolved": getattr(dataset, "unresolved", [])}
+
+        path = self.cacheFile(uri, casename)
+        from tempfile import mkstemp
+        import shutil
+        tmpFilename = None
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            fields, maps, records = pack(dataset)
+            data = [cPickle.dumps(r, cPickle.HIGHEST_PROTOCOL) for r in records]
+            offsets = [0]
+            for d in data:
+                offsets.append(offsets[-1] + len(d))
+            (fdes, tmpFilename) = mkstemp(".tmp", "koSchema_", self.cacheDir)
+            f = os.fdopen(fdes, "wb")
+            try:
+                f.write(MAGIC)
+                _writeBlock(f, header)
+                _writeBlock(f, (kind, fields, maps, offsets))
+                f.write("".join(data))
+            finally:
+                f.close()
+            shutil.move(tmpFilename, path)
+            log.info("saved schema cache for [%s] to [%s]", uri, path)
+        except Exception, e:
+            log.warn("Unable to write schema cache file [%s] [%s]", path, e)
+            if tmpFilename and os.path.exists(tmpFilename):
+                try:
+                    os.unlink(tmpFilename)
+                except OSError:
+                    pass
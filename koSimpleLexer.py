@@ -37,6 +37,7 @@
 import os
 import logging
 import re
+from bisect import bisect_right
 
 log = logging.getLogger("koSimpleLexer")
 # XXX duplicated in codeintel.parseutil, present here to make this entirely
@@ -61,6 +62,7 @@ class Lexer:
         self.text = ""
         self.textindex = 0
         self.tokennum2name = {}
+        self._linestarts = None # see lineno()
 
     def nexttok(self):
         self.lasttok = self.lasttok + 1
@@ -69,6 +71,7 @@ class Lexer:
     def settext(self, t):
         self.text = t
         self.textindex = 0
+        self._linestarts = None
 
     def addmatch(self, prg, func=None, tokname="", attributes=MAPTOK|EXECFN):
         self.prglist.append(prg)
@@ -84,6 +87,16 @@ class Lexer:
         self.prgmap[prg] = tok, attributes, func
         self.tokennum2name[tok] = tokname
 
+    def lineno(self, textindex=None):
+        """Return the 1-based line number of the given (by default the
+        current) text index.
+        """
+        if textindex is None:
+            textindex = self.textindex
+        if self._linestarts is None:
+            self._linestarts = [0] + [m.end() for m in _newlineRe.finditer(self.text)]
+        return bisect_right(self._linestarts, textindex)
+
     def scan(self):
         x = ""
         for prg in self.prglist:
@@ -101,17 +114,16 @@ class Lexer:
                     tmpres = apply(fn, (mo,))
                 except Exception, e:
                     log.exception(e)
-                    line = len(re.split('\r|\n|\r\n', self.text[:self.textindex]))
-                    raise Exception("Syntax Error in lexer at file %s line %d positon %d text[%s]" % (self.filename, line, self.textindex, self.text[self.textindex:self.textindex+300]))
+                    raise Exception("Syntax Error in lexer at file %s line %d positon %d text[%s]" % (self.filename, self.lineno(), self.textindex, self.text[self.textindex:self.textindex+300]))
             if attributes & USETXT:
                 t = ord(mo.group(0)[0])
             return (t, tmpres)
         if self.textindex >= len(self.text):
             return (self.eof, "")
         
-        line = len(re.split('\r|\n|\r\n', self.text[:self.textindex]))
-        raise Exception("Syntax Error in lexer at file %s line %d positon %d text[%s]" % (self.filename, line, self.textindex, self.text[self.textindex-20:self.textindex+300]))
+        raise Exception("Syntax Error in lexer at file %s line %d positon %d text[%s]" % (self.filename, self.lineno(), self.textindex, self.text[self.textindex-20:self.textindex+300]))
 
+_newlineRe = re.compile('\r\n|\r|\n')
 
 # regular expressions used in parsing SGML related documents
 class recollector:
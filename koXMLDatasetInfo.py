@@ -129,9 +129,10 @@ class DataSetHandler(EmptyDatasetHandler):
 class DatasetHandlerService:
     handlers = {} # empty dataset handlers
     resolver = None
+    schemaCacheDir = None # where the resolver caches schema datasets
     def __init__(self):
         self.defaultHandler = EmptyDatasetHandler()
-        self.resolver = CatalogResolver()
+        self.resolver = CatalogResolver(cacheDir=self.schemaCacheDir)
         
     def setCatalogs(self, catalogs):
         self.resolver.resetCatalogs(catalogs)
@@ -203,6 +204,10 @@ if _xpcom_:
             
             self._wrapped = WrapObject(self, components.interfaces.nsIObserver)
             self._prefSvc.prefs.prefObserverService.addObserver(self._wrapped,'xmlCatalogPaths',0);
+
+            koDirs = components.classes["@activestate.com/koDirs;1"].\
+              getService(components.interfaces.koIDirs)
+            self.schemaCacheDir = os.path.join(str(koDirs.userCacheDir), "schemas")
             
             PyDatasetHandlerService.__init__(self)
             self.reset()
@@ -36,6 +36,11 @@
 
 import time
 import re
+import threading
+import Queue
+from collections import OrderedDict
+from hashlib import md5
+from textutils import LineIndex
 from cElementTree import TreeBuilder, XMLParser, Element
 import logging
 log = logging.getLogger("koXMLTreeService")
@@ -155,10 +160,23 @@ def elementFromText(tree, text, parent=None):
 
 class iterparse:
     """iterparse that catches syntax errors so we can still handle any
-    events that happen prior to the syntax error"""
-    def __init__(self, content, events=("start", "end", "start-ns", "end-ns")):
+    events that happen prior to the syntax error
+
+    The content is fed to the parser `chunkSize` characters at a time
+    and the events are yielded as each chunk is parsed, so the consumer
+    can stop early (e.g. once the root element's namespaces are known,
+    or once a given position has been passed) by simply leaving the
+    loop. `root` is only set if the content was parsed to the end.
+    A false `chunkSize` feeds the content in one go.
+    """
+    chunkSize = 64 * 1024
+
+    def __init__(self, content, events=("start", "end", "start-ns", "end-ns"),
+                 chunkSize=None):
         self.content = content
         self._events = events
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
         self.err = None
         self.err_info = None
         self.root = None
@@ -168,15 +186,21 @@ class iterparse:
         b = TreeBuilder()
         p = XMLParser(b)
         p._setevents(events, self._events)
-        try:
-            p.feed(self.content)
-        except SyntaxError, e:
-            self.err = e
-            self.err_info = (p.CurrentLineNumber, p.CurrentColumnNumber, p.CurrentByteIndex)
-
-        for event in events:
-            yield event
-        del events[:]
+        content = self.content
+        length = len(content)
+        # at least 1, for empty content
+        chunkSize = max(1, self.chunkSize or length)
+        for pos in xrange(0, length, chunkSize):
+            try:
+                p.feed(content[pos:pos+chunkSize])
+            except SyntaxError, e:
+                self.err = e
+                self.err_info = (p.CurrentLineNumber, p.CurrentColumnNumber, p.CurrentByteIndex)
+            for event in events:
+                yield event
+            del events[:]
+            if self.err:
+                break
         try:
             self.root = p.close()
         except SyntaxError, e:
@@ -202,6 +226,8 @@ def bisect_left_nodes_start(a, x, lo=0, hi=None):
     return lo
 
 class XMLDocument(object):
+    # Attributes whose values are indexed in `attrValues`.
+    indexedAttrs = ("name",)
     
     def __init__(self, content=None):
         self.content = content
@@ -223,14 +249,21 @@ class XMLDocument(object):
         self.err_info = None
         self.root = None
         self.current = None
+        self.fingerprint = None # see contentFingerprint()
+        self.lineIndex = None # line start offsets of the parsed content
+        self._childrenIndex = None # see _buildNodeIndex()
 
         self._rootnodes = []
         self.nodes = [] # flat list of all nodes
         self.tags = {} # { namespace_uri: { tag_local_name: elem, ...} , ...}
+        self.elements = {} # { (namespace_uri, tag_local_name): [elem, ...], ... }
+        self.ids = {} # { id: elem, ... } for "id" and "xml:id" attributes
+        self.attrValues = {} # { attr_name: { value: [elem, ...] } } for indexedAttrs
         self.nodemap = {} # {child_elem: parent_elem, ... }
         self.namespaces = [] # flat list of namespace uri's
         self.nsmap = {} # { "http:/...": "xslt", ... }
         self.prefixmap = {} # { "xslt": "http://.....", ... }
+        self._nsdecls = {} # { elem: [(prefix, uri), ...], ... } for elems declaring namespaces
 
     def getRoots(self):
         # return a list of all nodes that have no parent
@@ -269,7 +302,97 @@ class XMLDocument(object):
         #print "-->isn't a parent"
         return False
 
+    def _buildNodeIndex(self):
+        """Build the index used by `locateNode()`.
+
+        The index maps each node (and None, for the top-level nodes) to
+        its child nodes in document order. As elements nest, this is a
+        nested containment list of the nodes' [start, end] ranges, so
+        the innermost node containing a position is found by bisecting
+        one list per level.
+
+        This is only valid if node positions are consistent: nodes in
+        increasing start order, and each node ending no later than its
+        parent (an unclosed node is taken to end where its parent
+        does). Otherwise (e.g. after some error recovery) the index is
+        not built and `locateNode()` walks the parent chain instead.
+        """
+        self._childrenIndex = None
+        childrenIndex = {None: []}
+        if self._indexNodes(self.nodes, childrenIndex, {None: None}):
+            self._childrenIndex = childrenIndex
+
+    def _indexNodes(self, nodes, childrenIndex, endFromNode):
+        """Add the given nodes to the index, returning False if their
+        positions are inconsistent. The parent of the first node must
+        already be in `endFromNode`.
+        """
+        last_start = None
+        for node in nodes:
+            start = node.start
+            if not start or (last_start is not None and start[:2] <= last_start):
+                return False
+            last_start = start[:2]
+            parent = self.nodemap.get(node)
+            if parent not in endFromNode:
+                return False
+            parent_end = endFromNode[parent]
+            if node.end:
+                end = node.end[:2]
+                if parent_end is not None and end > parent_end:
+                    return False
+                endFromNode[node] = end
+            else:
+                endFromNode[node] = parent_end
+            if parent in childrenIndex:
+                childrenIndex[parent].append(node)
+            else:
+                childrenIndex[parent] = [node]
+        return True
+
     def locateNode(self, line, col):
+        if self._childrenIndex is None:
+            return self._locateNodeByWalk(line, col)
+        # nodes are 1-indexed, so we need to switch our indexing scheme
+        pos = (line + 1, col)
+
+        # Descend from the top-level nodes to the innermost node whose
+        # range contains the position.
+        node = None
+        lo = 0
+        children = self._childrenIndex[None]
+        while children:
+            # find the last child to start before the position
+            lo, hi = 0, len(children)
+            while lo < hi:
+                mid = (lo+hi)//2
+                if children[mid].start[:2] < pos: lo = mid+1
+                else: hi = mid
+            if lo == 0:
+                break
+            child = children[lo-1]
+            if child.end and child.end[:2] < pos:
+                break
+            node = child
+            children = self._childrenIndex.get(node)
+        if node is None and lo == 0 and self.nodes:
+            # before all nodes
+            return self.nodes[0]
+        return node
+
+    def locateAncestors(self, line, col):
+        """Return the list of nodes containing the given position, from
+        the outermost to the innermost (i.e. `locateNode()`).
+        """
+        ancestors = []
+        node = self.locateNode(line, col)
+        while node is not None:
+            ancestors.append(node)
+            node = self.parent(node)
+        ancestors.reverse()
+        return ancestors
+
+    def _locateNodeByWalk(self, line, col):
         # nodes are 1-indexed, so we need to switch our indexing scheme
         line += 1
 
@@ -319,6 +442,79 @@ class XMLDocument(object):
                 
         return node
 
+    _xmlIdAttr = "{http://www.w3.org/XML/1998/namespace}id"
+
+    def _buildElementIndex(self):
+        """Index the nodes by name, id and `indexedAttrs` values, in
+        document order.
+        """
+        self.elements = elements = {}
+        self.ids = ids = {}
+        self.attrValues = attrValues = {}
+        for attr in self.indexedAttrs:
+            attrValues[attr] = {}
+        indexedAttrs = [(attr, attrValues[attr]) for attr in self.indexedAttrs]
+        xmlIdAttr = self._xmlIdAttr
+        for node in self.nodes:
+            key = (node.ns, node.localName)
+            if key in elements:
+                elements[key].append(node)
+            else:
+                elements[key] = [node]
+            attrib = node.attrib
+            if not attrib:
+                continue
+            id = attrib.get(xmlIdAttr) or attrib.get("id")
+            if id and id not in ids:
+                ids[id] = node
+            for attr, nodesFromValue in indexedAttrs:
+                value = attrib.get(attr)
+                if value is not None:
+                    if value in nodesFromValue:
+                        nodesFromValue[value].append(node)
+                    else:
+                        nodesFromValue[value] = [node]
+
+    def getElements(self, ns, localName):
+        """Return all elements with the given namespace URI (None for
+        none) and local name, in document order.
+        """
+        return self.elements.get((ns, localName), [])
+
+    def getElementById(self, id):
+        """Return the (first) element with the given "id" or "xml:id"
+        attribute value, or None.
+        """
+        return self.ids.get(id)
+
+    def getElementsByAttr(self, attr, value, ns=None, localName=None):
+        """Return the elements with the given attribute value, in
+        document order, optionally only those with the given namespace
+        URI and local name. E.g. the XSLT templates named "foo":
+
+            tree.getElementsByAttr("name", "foo", XSLT_NS, "template")
+
+        This is an index lookup for attributes in `indexedAttrs`, else
+        a scan of all elements.
+        """
+        if attr in self.attrValues:
+            nodes = self.attrValues[attr].get(value, [])
+        else:
+            nodes = [n for n in self.nodes if n.get(attr) == value]
+        if localName is not None:
+            nodes = [n for n in nodes
+                     if n.localName == localName and n.ns == ns]
+        return nodes
+
+    def locateNodeAtOffset(self, offset):
+        """Like `locateNode()`, but for a char offset in the parsed
+        content.
+        """
+        if self.lineIndex is None:
+            return None
+        line, col = self.lineIndex.line_col_from_offset(offset)
+        return self.locateNode(line, col)
+
     def prefixFromNS(self, ns):
         if self.prefixmap.get("") == ns:
             return ""
@@ -347,15 +543,20 @@ class XMLDocument(object):
             self.getDoctype()
         elif not self.content:
             raise Exception("no content to parse")
+        self.lineIndex = LineIndex(self.content)
         
         elstack = [None]
         self.current = None
         tags = {}
         last_pos_ok = None
+        nsdecls = []
         iter = iterparse(self.content)
         for event, elem in iter:
             if event == "start":
                 #print "%r %r %d %d %d" % (event, elem, elem.start[0], elem.start[1], elem.start[2])
+                if nsdecls:
+                    self._nsdecls[elem] = nsdecls
+                    nsdecls = []
                 self.nodemap[elem] = self.current
                 self.nodes.append(elem)
                 if elem.ns not in self.tags:
@@ -365,22 +566,7 @@ class XMLDocument(object):
                 self.current = elem
             elif event == "end":
                 #print "%r %r %r %r" % (event, elem, elem.start, elem.end)
-                if elem.end:
-                    try:
-                        pos = elem.end[2]
-                        #print "  len %d pos %d" % (len(self.content), pos)
-                        # put the end location at the end of the end tag
-                        m = self._endtagRe.match(self.content[pos:])
-                        if m and m.groups():
-                            pos = pos + m.end(1)
-                            if pos > 0:
-                                # we want to be after the ">"
-                                diff = pos - elem.end[2] + 1 
-                                elem.end = (elem.end[0], elem.end[1] + diff, pos)
-                    except IndexError, e:
-                        # XXX FIXME BUG 56337
-                        log.exception(e)
-                        pass
+                self._fixupEnd(elem, self.content)
                 node = elstack.pop()
                 if elstack[-1] is None:
                     self._rootnodes.append(node)
@@ -389,6 +575,7 @@ class XMLDocument(object):
                 self.namespaces.append(elem)
                 self.prefixmap[elem[0]] = elem[1]
                 self.nsmap[elem[1]] = elem[0]
+                nsdecls.append(elem)
             elif event == "end-ns":
                 self.namespaces.pop()
         self.root = iter.root
@@ -402,9 +589,251 @@ class XMLDocument(object):
         # now, as we should have a node
         if self.root is None and self.nodes:
             self.root = self.nodes[0]
+        self._buildNodeIndex()
+        self._buildElementIndex()
         # release content
         self.content = None
 
+    def _fixupEnd(self, elem, content):
+        if elem.end:
+            try:
+                pos = elem.end[2]
+                #print "  len %d pos %d" % (len(content), pos)
+                # put the end location at the end of the end tag
+                m = self._endtagRe.match(content, pos)
+                if m and m.groups():
+                    pos = m.end(1)
+                    if pos > 0:
+                        # we want to be after the ">"
+                        diff = pos - elem.end[2] + 1 
+                        elem.end = (elem.end[0], elem.end[1] + diff, pos)
+            except IndexError, e:
+                # XXX FIXME BUG 56337
+                log.exception(e)
+                pass
+
+    _starttagRe = re.compile("<%(Name)s(?:%(S)s%(Name)s(?:%(S)s)?=(?:%(S)s)?(?:%(AttValSE)s))*(?:%(S)s)?>"
+                             % collector.regs, re.U)
+    _fragmentTag = "koXMLTreeServiceFragment"
+    _internalSubsetRe = re.compile(r"""<!DOCTYPE(?:[^>\["']|"[^"]*"|'[^']*')*\[""")
+
+    def update(self, content, changed_start, changed_end, delta):
+        """Update the tree for an edit of the parsed content.
+
+        `content` is the full new content. The edit replaced the chars
+        `changed_start` to `changed_end` of the previously parsed content
+        with `delta` more (or, if negative, fewer) chars.
+
+        Only the smallest element that contains the whole edit in its
+        content (i.e. not touching its start or end tag) is re-parsed;
+        its new nodes are spliced in and the positions of the nodes
+        after it are shifted. A full parse is done instead if the last
+        parse had errors or the fragment has any, if the edit is not
+        within the root element, if namespace declarations within the
+        element change, or if the doctype has an internal subset (whose
+        entities and attribute defaults the fragment would miss).
+
+        Returns True if the update was incremental, False if it was a
+        full parse.
+        """
+        try:
+            if self._updateFragment(content, changed_start, changed_end, delta):
+                # the tree is no longer that of the fingerprinted content
+                self.fingerprint = None
+                return True
+        except (AttributeError, TypeError), ex:
+            # E.g. element positions aren't settable.
+            log.debug("incremental update failed: %s", ex)
+        self.parse(content)
+        return False
+
+    def _enclosingElement(self, content, changed_start, changed_end, delta):
+        """Return the smallest element whose content contains the edit,
+        and the start and end of it in the new content.
+        """
+        nodes = self.nodes
+        lo, hi = 0, len(nodes)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if nodes[mid].start[2] < changed_start: lo = mid+1
+            else: hi = mid
+        elem = None
+        if lo > 0:
+            elem = nodes[lo-1]
+        while elem is not None:
+            if elem.end and elem.end[2] > changed_end:
+                start = elem.start[2]
+                m = self._starttagRe.match(content, start)
+                end = elem.end[2] + delta
+                endtag_start = content.rfind("</", 0, end)
+                if m and m.end() <= changed_start \
+                   and endtag_start >= changed_end + delta:
+                    m = self._endtagRe.match(content, endtag_start)
+                    if m and m.end() == end:
+                        return elem, start, end
+            elem = self.parent(elem)
+        return None, None, None
+
+    def _updateFragment(self, content, changed_start, changed_end, delta):
+        if self.err or self.root is None or not self.nodes:
+            return False
+        if changed_start <= self.root.start[2]:
+            # The edit is in the prolog, e.g. the doctype.
+            return False
+        if self._internalSubsetRe.search(content, 0, self.root.start[2]):
+            # The fragment might use entities or attribute defaults
+            # (e.g. #FIXED xmlns) declared in the doctype.
+            return False
+        elem, start, end = self._enclosingElement(content, changed_start,
+                                                  changed_end, delta)
+        if elem is None:
+            return False
+        nodes = self.nodes
+        i = nodes.index(elem)
+        old_end = elem.end
+        j = i + 1
+        while j < len(nodes) and nodes[j].start[2] < old_end[2]:
+            j += 1
+        # Parse the fragment inside a wrapper element declaring the
+        # namespaces in scope, on the same line so that the positions
+        # are easy to map.
+        nsdecls = {}
+        ancestor = self.parent(elem)
+        while ancestor is not None:
+            for prefix, uri in self._nsdecls.get(ancestor, ()):
+                nsdecls.setdefault(prefix, uri)
+            ancestor = self.parent(ancestor)
+        wrapper = ["<", self._fragmentTag]
+        for prefix, uri in nsdecls.items():
+            uri = uri.replace("&", "&amp;").replace('"', "&quot;")
+            if prefix:
+                wrapper.append(' xmlns:%s="%s"' % (prefix, uri))
+            else:
+                wrapper.append(' xmlns="%s"' % uri)
+        wrapper.append(">")
+        fragment = "".join(wrapper) + content[start:end] \
+                   + "</%s>" % self._fragmentTag
+
+        new_nodes = []
+        nodemap = {}
+        new_nsdecls = {}
+        elstack = []
+        pending_nsdecls = []
+        iter = iterparse(fragment)
+        for event, node in iter:
+            if event == "start":
+                if not elstack:
+                    # the wrapper
+                    pending_nsdecls = []
+                    elstack.append(None)
+                    continue
+                if pending_nsdecls:
+                    new_nsdecls[node] = pending_nsdecls
+                    pending_nsdecls = []
+                nodemap[node] = elstack[-1]
+                new_nodes.append(node)
+                elstack.append(node)
+            elif event == "end":
+                elstack.pop()
+            elif event == "start-ns":
+                pending_nsdecls.append(node)
+        if iter.err or not new_nodes or new_nodes[0].tag != elem.tag:
+            return False
+        if [self._nsdecls[n] for n in nodes[i:j] if n in self._nsdecls] \
+           != [new_nsdecls[n] for n in new_nodes if n in new_nsdecls]:
+            # The namespace declarations changed, so `prefixmap` and
+            # `nsmap` might too.
+            return False
+        new_elem = new_nodes[0]
+        if nodemap.get(new_elem) is not None \
+           or [n for n in new_nodes[1:] if nodemap[n] is None]:
+            return False
+
+        # Map the positions in the fragment to the new content.
+        raw_start = new_elem.start
+        line_offset = elem.start[0] - raw_start[0]
+        col_offset = elem.start[1] - raw_start[1]
+        pos_offset = elem.start[2] - raw_start[2]
+        def mapPosition(pos):
+            if not pos:
+                return pos
+            line, col, offset = pos[:3]
+            if line == raw_start[0]:
+                col += col_offset
+            return (line + line_offset, col, offset + pos_offset) + tuple(pos[3:])
+        for node in new_nodes:
+            node.start = mapPosition(node.start)
+            node.end = mapPosition(node.end)
+            self._fixupEnd(node, content)
+        new_end = new_elem.end
+        if not new_end or new_end[2] != end:
+            return False
+
+        # Shift the positions after the element.
+        line_delta = new_end[0] - old_end[0]
+        col_delta = new_end[1] - old_end[1]
+        def shiftPosition(pos):
+            if not pos or pos[2] < old_end[2]:
+                return pos
+            line, col, offset = pos[:3]
+            if line == old_end[0]:
+                col += col_delta
+            return (line + line_delta, col, offset + delta) + tuple(pos[3:])
+        for node in nodes[:i]:
+            # only ancestors can end after the element
+            node.end = shiftPosition(node.end)
+        for node in nodes[j:]:
+            node.start = shiftPosition(node.start)
+            node.end = shiftPosition(node.end)
+
+        # Splice in the new nodes.
+        parent = self.parent(elem)
+        new_elem.tail = elem.tail
+        if parent is not None:
+            for k, child in enumerate(parent):
+                if child is elem:
+                    parent[k] = new_elem
+                    break
+        if self.root is elem:
+            self.root = new_elem
+        for k, node in enumerate(self._rootnodes):
+            if node is elem:
+                self._rootnodes[k] = new_elem
+        for node in nodes[i:j]:
+            del self.nodemap[node]
+            self._nsdecls.pop(node, None)
+        nodemap[new_elem] = parent
+        self.nodemap.update(nodemap)
+        self._nsdecls.update(new_nsdecls)
+        if self._childrenIndex is not None:
+            # Only the element's subtree changes in the node index.
+            for node in nodes[i:j]:
+                self._childrenIndex.pop(node, None)
+            siblings = self._childrenIndex[parent]
+            for k, node in enumerate(siblings):
+                if node is elem:
+                    siblings[k] = new_elem
+                    break
+            endFromNode = {parent: None}
+            if parent is not None and parent.end:
+                endFromNode[parent] = parent.end[:2]
+            subtreeIndex = {}
+            if self._indexNodes(new_nodes, subtreeIndex, endFromNode):
+                del subtreeIndex[parent]
+                self._childrenIndex.update(subtreeIndex)
+            else:
+                self._childrenIndex = None
+        nodes[i:j] = new_nodes
+        self.tags = {}
+        for node in nodes:
+            if node.ns not in self.tags:
+                self.tags[node.ns] = {}
+            self.tags[node.ns][node.localName] = node
+        self._buildElementIndex()
+        self.current = None
+        self.lineIndex = LineIndex(content)
+        return True
+
     def end_error(self, content):
         if not self.err_info:
             return
@@ -415,13 +844,9 @@ class XMLDocument(object):
         if self.err_info[2] >= 0:
             start = self.err_info[2]
         else:
-            # slower
             #print self.err_info
-            p = 0
-            for i in range(self.err_info[0] - 1):
-                # use re.search("\r|\n|\r\n")
-                p = content.find("\n", p + 1)
-            start = p + self.err_info[1] + 1
+            line = min(self.err_info[0], len(self.lineIndex)) - 1
+            start = self.lineIndex.offset_from_line_col(line, self.err_info[1])
         end = content.find("<", start+1)
         if end <= start:
             end = len(content)
@@ -438,9 +863,8 @@ class XMLDocument(object):
         #print "%s:%s %r %d" % current
         # fix error info
         start = start+current[3]
-        line = content.count('\n', 0, start)
-        col = start - content.rfind('\n', 0, start)
-        self.err_info = (line, col, start)
+        line, col = self.lineIndex.line_col_from_offset(start)
+        self.err_info = (line, col + 1, start)
         self.current = elem = elementFromTag(self, current, parent)
     
     def dump(self):
@@ -480,31 +904,271 @@ class HTMLDocument(XMLDocument):
         self.nodemap = p._builder.nodemap
         self._rootnodes = p._builder._rootnodes
         self.current = p._builder.current
+        self.lineIndex = p.lineIndex
+        self._buildNodeIndex()
+        self._buildElementIndex()
+
+    def update(self, content, changed_start, changed_end, delta):
+        # The HTML parser has no incremental mode.
+        self.parse(content)
+        return False
+
+def contentFingerprint(content):
+    """Return a fingerprint of the given document content: its length
+    and an MD5 digest.
+    """
+    if isinstance(content, unicode):
+        digest = md5(content.encode("utf-8")).digest()
+    else:
+        digest = md5(content).digest()
+    return (type(content), len(content), digest)
+
+class TreeCache(object):
+    """A bounded cache of parsed documents keyed on URI.
+
+    Least recently used documents are evicted when there are more than
+    `maxEntries` of them, or when their approximate size in bytes (see
+    `treeSize()`) adds up to more than `maxBytes`. The most recently
+    used document is always kept, even if it is bigger than `maxBytes`.
+
+    The cache is shared by all TreeService instances and their parse
+    threads, and locks itself.
+    """
+    # Rough memory cost of a node: the element itself, its entry in
+    # the document's node list and node map, and its start/end tuples.
+    nodeOverhead = 400
+
+    def __init__(self, maxEntries=50, maxBytes=64*1024*1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._trees = OrderedDict() # uri -> (tree, size)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __contains__(self, uri):
+        return uri in self._trees
+
+    def treeSize(self, tree):
+        """Return the approximate size in bytes of the given document,
+        from its number of nodes and the size of their attributes.
+        """
+        size = 0
+        for node in tree.nodes:
+            size += self.nodeOverhead
+            if isinstance(node.tag, basestring):
+                size += len(node.tag)
+            for name, value in node.items():
+                size += len(name) + len(value or "")
+        return size
+
+    def get(self, uri):
+        """Return the document cached for the given URI, or None."""
+        self._lock.acquire()
+        try:
+            try:
+                tree, size = self._trees.pop(uri)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._trees[uri] = (tree, size)
+            self.hits += 1
+            return tree
+        finally:
+            self._lock.release()
+
+    def put(self, uri, tree):
+        """Cache the given document for the given URI, evicting others
+        if that goes over the limits.
+
+        Call this again after re-parsing a cached document in place, to
+        update its size.
+        """
+        size = self.treeSize(tree)
+        self._lock.acquire()
+        try:
+            if uri in self._trees:
+                self.bytes -= self._trees.pop(uri)[1]
+            self._trees[uri] = (tree, size)
+            self.bytes += size
+            while len(self._trees) > 1 and (len(self._trees) > self.maxEntries
+                                            or self.bytes > self.maxBytes):
+                evicted_uri, (evicted_tree, evicted_size) \
+                    = self._trees.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+                log.debug("evicted tree for [%s] (%d bytes)",
+                          evicted_uri, evicted_size)
+        finally:
+            self._lock.release()
+
+    def evict(self, uri):
+        """Drop the document cached for the given URI, if any."""
+        self._lock.acquire()
+        try:
+            if uri in self._trees:
+                self.bytes -= self._trees.pop(uri)[1]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._trees.clear()
+            self.bytes = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "entries": len(self._trees),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+        finally:
+            self._lock.release()
+
+class ParseFuture(object):
+    """The pending result of TreeService.getTreeForURIAsync().
+
+    `staleTree` is the latest tree completed for the URI when the request
+    was made (or None), usable while the new one is being built.
+    """
+    def __init__(self, staleTree=None):
+        self.staleTree = staleTree
+        self._tree = None
+        self._exception = None
+        self._callbacks = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for and return the parsed tree, or None on timeout.
+        Re-raises any exception the parse raised.
+        """
+        if not self._done.wait(timeout):
+            return None
+        if self._exception is not None:
+            raise self._exception
+        return self._tree
+
+    def exception(self, timeout=None):
+        self._done.wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once the tree is ready (right away if it is)."""
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def _set(self, tree=None, exception=None):
+        self._lock.acquire()
+        try:
+            self._tree = tree
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception("error in ParseFuture callback")
+
+class _ParseJob(object):
+    """A parse queued or running for one URI, and the futures waiting on
+    it. `next` is the job queued behind a running one.
+    """
+    __slots__ = ("uri", "content", "fingerprint", "futures", "running", "next")
+    def __init__(self, uri, content, fingerprint):
+        self.uri = uri
+        self.content = content
+        self.fingerprint = fingerprint
+        self.futures = []
+        self.running = False
+        self.next = None
 
 class TreeService:
-    __treeMap = {} # map uri to elementtree
+    __treeCache = TreeCache() # map uri to elementtree
+    # Number of background parse threads for getTreeForURIAsync(). The
+    # parsers hold the GIL, so more than one mostly adds contention.
+    parseWorkers = 1
     def __init__(self):
-        pass
+        # Time spent fingerprinting and parsing content, and the number
+        # of parses avoided because content was unchanged.
+        self.hashTime = 0.0
+        self.parseTime = 0.0
+        self.parses = 0
+        self.unchangedHits = 0
+        # getTreeForURIAsync() state
+        self._lock = threading.Lock()
+        self._jobs = {} # { uri: _ParseJob, ... } queued or running
+        self._queue = None
+        self._workers = []
+
+    @property
+    def cache(self):
+        return self.__treeCache
 
     def treeFromCache(self, uri):
-        if uri in self.__treeMap:
-            #print "tree cache hit for [%s]"%uri
-            return self.__treeMap[uri]
-        return None
+        return self.__treeCache.get(uri)
+
+    def evict(self, uri):
+        """Drop the cached tree for the given URI, e.g. when it is closed."""
+        self.__treeCache.evict(uri)
+
+    def clear(self):
+        self.__treeCache.clear()
+
+    def stats(self):
+        stats = self.__treeCache.stats()
+        stats.update(hashTime=self.hashTime, parseTime=self.parseTime,
+                     parses=self.parses, unchangedHits=self.unchangedHits)
+        return stats
     
     def getTreeForURI(self, uri, content=None):
         if not uri and not content:
             return None
-        tree = None
-        if uri and uri in self.__treeMap:
-            tree = self.__treeMap[uri]
+        fingerprint = None
+        if uri:
+            tree = self.__treeCache.get(uri)
             #if tree is not None:
             #    print "tree cache hit for [%s]"%uri
-            if not content:
+            if tree is not None and not content:
                 return tree
-
-        if not tree:
-            if not content:
+            if content:
+                # Don't re-parse content identical to the last parse.
+                t1 = time.time()
+                fingerprint = contentFingerprint(content)
+                self._lock.acquire()
+                try:
+                    self.hashTime += time.time() - t1
+                    if tree is not None and tree.fingerprint == fingerprint:
+                        self.unchangedHits += 1
+                        return tree
+                finally:
+                    self._lock.release()
+            elif tree is None:
                 # get the content
                 try:
                     f = open(uri, 'r')
@@ -513,21 +1177,183 @@ class TreeService:
                 except IOError, e:
                     # ignore file errors and return an empty tree
                     content = ""
-            if not content.startswith("<?xml"):
-                tree = HTMLDocument()
-            if not tree:
-                tree = XMLDocument()
-                #raise Exception("NOT IMPLEMENTED YET")
+
+        # Parse into a new tree, the cached one may be in use by another
+        # thread or held as a ParseFuture's staleTree.
+        tree = self._newTree(content)
         if content:
-            tree.parse(content)
+            t1 = time.time()
+            try:
+                tree.parse(content)
+            finally:
+                self._lock.acquire()
+                try:
+                    self.parseTime += time.time() - t1
+                    self.parses += 1
+                finally:
+                    self._lock.release()
+            tree.fingerprint = fingerprint
         if uri:
-            self.__treeMap[uri] = tree
+            # only reached if the parse succeeded
+            self.__treeCache.put(uri, tree)
         return tree
     
     def getTreeForContent(self, content):
         return self.getTreeForURI(None, content)
+
+    def _newTree(self, content):
+        if not content.startswith("<?xml"):
+            return HTMLDocument()
+        return XMLDocument()
+        #raise Exception("NOT IMPLEMENTED YET")
+
+    def getTreeForURIAsync(self, uri, content=None):
+        """Parse the content for the URI on a background thread and
+        return a ParseFuture for the tree.
+
+        Requests are coalesced per URI: a newer request replaces the
+        content of one still queued (the futures of both get the newer
+        tree), and a request for the content being parsed just waits
+        for that parse. The previous tree is not modified, it stays
+        available as the future's `staleTree` until the new one is
+        cached.
+        """
+        if not uri:
+            future = ParseFuture()
+            future._set(self.getTreeForContent(content))
+            return future
+        fingerprint = None
+        if content:
+            t1 = time.time()
+            fingerprint = contentFingerprint(content)
+        self._lock.acquire()
+        try:
+            if content:
+                self.hashTime += time.time() - t1
+            tree = self.__treeCache.get(uri)
+            future = ParseFuture(tree)
+            if tree is not None and (not content or
+                                     tree.fingerprint == fingerprint):
+                self.unchangedHits += 1
+                future._set(tree)
+                return future
+            job = self._jobs.get(uri)
+            if job is None:
+                job = self._jobs[uri] = _ParseJob(uri, content, fingerprint)
+                self._startWorkers()
+                self._queue.put(uri)
+            elif job.running:
+                if job.fingerprint == fingerprint:
+                    if job.next is not None:
+                        # back to the content being parsed
+                        job.futures += job.next.futures
+                        job.next = None
+                else:
+                    if job.next is None:
+                        job.next = _ParseJob(uri, content, fingerprint)
+                    job = job.next
+            if job.fingerprint != fingerprint:
+                # supersede the queued content
+                job.content = content
+                job.fingerprint = fingerprint
+            job.futures.append(future)
+            return future
+        finally:
+            self._lock.release()
+
+    def _startWorkers(self):
+        if self._queue is None:
+            self._queue = Queue.Queue()
+        while len(self._workers) < self.parseWorkers:
+            t = threading.Thread(target=self._parseWorker,
+                                 name="koXMLTreeService parser")
+            t.setDaemon(True)
+            self._workers.append(t)
+            t.start()
+
+    def _parseWorker(self):
+        while 1:
+            uri = self._queue.get()
+            self._lock.acquire()
+            try:
+                job = self._jobs[uri]
+                job.running = True
+                content = job.content
+            finally:
+                self._lock.release()
+            tree = exception = None
+            t1 = time.time()
+            try:
+                if not content:
+                    try:
+                        f = open(uri, 'r')
+                        content = f.read(-1)
+                        f.close()
+                    except IOError, e:
+                        # ignore file errors and return an empty tree
+                        content = ""
+                tree = self._newTree(content)
+                if content:
+                    tree.parse(content)
+                    tree.fingerprint = job.fingerprint
+            except Exception, e:
+                log.exception("error parsing %s", uri)
+                exception = e
+            self._lock.acquire()
+            try:
+                if content:
+                    self.parseTime += time.time() - t1
+                    self.parses += 1
+                if exception is None:
+                    # a failed parse leaves a half-built tree, keep the
+                    # stale one
+                    self.__treeCache.put(uri, tree)
+                if job.next is not None:
+                    self._jobs[uri] = job.next
+                    self._queue.put(uri)
+                else:
+                    del self._jobs[uri]
+            finally:
+                self._lock.release()
+            for future in job.futures:
+                future._set(tree, exception)
         
 
+def _benchmarkDocument(size, depth=1):
+    """Generate an XML document of about `size` bytes whose elements are
+    nested `depth` deep.
+    """
+    leaf = '<item id="%d" name="n%d">some text</item>\n'
+    parts = ['<?xml version="1.0"?>\n<root>\n']
+    total = 0
+    n = 0
+    while total < size:
+        for i in range(depth - 1):
+            parts.append('<level depth="%d">' % i)
+        parts.append(leaf % (n, n))
+        parts.append('</level>' * (depth - 1))
+        total += len(leaf) + 35 * (depth - 1)
+        n += 1
+    parts.append('</root>\n')
+    return "".join(parts)
+
+def _benchmarkParse(sizes=(1024, 10*1024, 100*1024, 1024*1024,
+                           5*1024*1024, 20*1024*1024),
+                    depths=(1, 50)):
+    """Time XMLDocument.parse() on generated documents. The time per KB
+    should stay roughly flat as the size grows.
+    """
+    print "%10s %6s %10s %10s %10s" % ("bytes", "depth", "nodes", "secs", "usecs/KB")
+    for depth in depths:
+        for size in sizes:
+            content = _benchmarkDocument(size, depth)
+            tree = XMLDocument()
+            t1 = time.time()
+            tree.parse(content)
+            t = time.time() - t1
+            print "%10d %6d %10d %10.3f %10.1f" % (len(content), depth,
+                len(tree.nodes), t, t * 1e6 / (len(content) / 1024.0))
+
 __treeservice = None
 def getService():
     global __treeservice
@@ -547,6 +1373,10 @@ if __name__ == "__main__":
     # add the handler to the root logger
     logging.getLogger('').addHandler(console)
 
+    if sys.argv[1:] == ["benchmark"]:
+        _benchmarkParse()
+        sys.exit(0)
+
     bigfile = "/Users/shanec/main/Apps/Komodo-devel/test/bigfile.xml"
     fn = "/Users/shanec/main/Apps/Komodo-devel/src/samples/xslt_sample.xsl"
     from elementtree.ElementTree import tostring
@@ -657,6 +1487,19 @@ if __name__ == "__main__":
     assert node is None, "locateNode returned incorrect node"
     node = tree.locateNode(0, 7)
     assert node is not None, "locateNode returned incorrect node"
+
+    # a sync parse must leave the cached tree, which a ParseFuture may
+    # hold as its staleTree, untouched
+    xml = """<?xml version="1.0"?>\n<stale><child/></stale>\n"""
+    staleTree = getService().getTreeForURI("stale.xml", xml)
+    staleRoot = staleTree.root
+    tree = getService().getTreeForURI("stale.xml", """<?xml version="1.0"?>\n<fresh/>\n""")
+    assert tree is not staleTree, "the stale tree was re-parsed"
+    assert staleTree.root is staleRoot, "the stale tree was modified"
+    assert staleTree.root.localName == "stale", "the stale tree was modified"
+    assert [child.localName for child in staleTree.root] == ["child"], \
+           "the stale tree was modified"
+    assert tree.root.localName == "fresh", "incorrect tree for new content"
     sys.exit(0)
     
     xml = """
@@ -190,40 +190,26 @@ class LangInfo(object):
 
     def conforms_to(self, lang):
         """Returns True iff this language conforms to the given `lang`."""
-        if lang == self.name:
-            return True
-        if self.conforms_to_bases:
-            if lang in self.conforms_to_bases:
-                return True
-            for base in self.conforms_to_bases:
-                try:
-                    base_li = self._db.langinfo_from_lang(base)
-                except LangInfoError:
-                    pass
-                else:
-                    if base_li.conforms_to(lang):
-                        return True
-        return False
+        return lang in self._db._conformance(self)[0]
 
     def conformant_attr(self, attr):
         """Returns the value of the given attr, inheriting from the
         `conforms_to_bases` languages if not directly defined for this
         language.
         """
-        if hasattr(self, attr):
-            val = getattr(self, attr)
-            if val is not None:
-                return val
-        for base in self.conforms_to_bases or []:
-            try:
-                base_li = self._db.langinfo_from_lang(base)
-            except LangInfoError:
-                pass
-            else:
-                val = base_li.conformant_attr(attr)
+        conforms_to, conformance_order, attrs = self._db._conformance(self)
+        try:
+            return attrs[attr]
+        except KeyError:
+            pass
+        val = None
+        for li in conformance_order:
+            if hasattr(li, attr):
+                val = getattr(li, attr)
                 if val is not None:
-                    return val
-        return None
+                    break
+        attrs[attr] = val
+        return val
         
 
 
@@ -247,28 +233,345 @@ def _generateFallbackKoLangInfo(langinfo_db, koLangInst):
                 self.exts = [koLang.defaultExtension]
     return FallbackKoLangInfo(langinfo_db, koLangInst)
 
+class _LazyRegex(object):
+    """A stand-in for a compiled regex that only compiles the regex on
+    first use.
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __reduce__(self):
+        return (_LazyRegex, (self.pattern, self.flags))
+
+    def __getattr__(self, attr):
+        # Only called for attributes not yet set, e.g. `search`.
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        regex = re.compile(self.pattern, self.flags)
+        for name in ("search", "match", "finditer", "findall", "sub",
+                     "split", "groupindex", "groups"):
+            setattr(self, name, getattr(regex, name))
+        return getattr(regex, attr)
+
+_regex_type = type(re.compile(""))
+def _lazy_regexes_from_value(value):
+    """Return a copy of the given (langinfo attribute) value with
+    compiled regexes replaced by `_LazyRegex`es, for pickling.
+    """
+    if isinstance(value, _regex_type):
+        return _LazyRegex(value.pattern, value.flags)
+    elif isinstance(value, list):
+        return [_lazy_regexes_from_value(v) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(_lazy_regexes_from_value(v) for v in value)
+    elif isinstance(value, dict):
+        return dict((k, _lazy_regexes_from_value(v))
+                    for k, v in value.items())
+    return value
+
+class _SnapshotLangInfo(LangInfo):
+    """A LangInfo loaded from a database snapshot.
+
+    Only the core attributes (`snapshot_attrs`) are stored in the
+    snapshot. Accessing any other attribute imports the defining
+    `langinfo_*.py` module and delegates to a real instance of the
+    LangInfo class.
+    """
+    snapshot_attrs = ("name", "exts", "filename_patterns", "magic_numbers",
+                      "doctypes", "specialization_hints_from_lang",
+                      "emacs_modes", "vi_filetypes",
+                      "_magic_number_precedence", "default_encoding",
+                      "encoding_decl_pattern", "conforms_to_bases",
+                      "has_significant_trailing_ws", "komodo_name",
+                      "is_minor_variant")
+    _real_langinfo_cache = None
+
+    def __init__(self, db, module_path, class_name, attrs):
+        LangInfo.__init__(self, db)
+        self._module_path = module_path
+        self._class_name = class_name
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, attr):
+        # Only called for attributes not stored in the snapshot.
+        if attr.startswith("__") or attr in self.snapshot_attrs:
+            raise AttributeError(attr)
+        return getattr(self._real_langinfo(), attr)
+
+    # Modules imported for `_real_langinfo()`, keyed on path.
+    _module_from_path = {}
+
+    def _real_langinfo(self):
+        if self._real_langinfo_cache is None:
+            module = self._module_from_path.get(self._module_path)
+            if module is None:
+                module = _module_from_path(self._module_path)
+                self._module_from_path[self._module_path] = module
+            cls = getattr(module, self._class_name)
+            self._real_langinfo_cache = cls(self._db)
+        return self._real_langinfo_cache
+
+
+class _MagicMatcher(object):
+    """An index of a database's sorted magic number table, so that
+    `Database.langinfo_from_magic()` doesn't have to try every entry.
+
+    - "string" magics are keyed on their start offset and then on their
+      first few bytes (as many as the shortest pattern at that offset).
+    - struct magics are grouped by start offset and format, with the
+      struct size computed once: one unpack per group is then a dict
+      lookup on the value.
+    - "regex" magics that are anchored to the start of the string (as
+      all shebang patterns are) are merged into one alternation per
+      start offset and flags, the matching group naming the entry.
+      Others are tried one at a time.
+
+    Each entry keeps its index in the table as its "order". The first
+    matching entry in the table wins, as for a linear scan of it.
+    """
+    def __init__(self, magic_table):
+        self._strings_from_start = {}  # <start> -> <key-len>, {<key> -> [...]}
+        self._structs = []  # list of (<start>, <length>, <format>, {<value> -> <hit>})
+        self._regexes = []  # list of (<min-order>, <start>, <match-func>, <hit-from-group>)
+        structs = {}
+        regexes = {}
+        for order, (magic_number, li, sort_key) in enumerate(magic_table):
+            try:
+                start, format, pattern = magic_number
+            except ValueError:
+                # Silently drop bogus magic number decls.
+                continue
+            if format == "string":
+                self._strings_from_start.setdefault(start, []).append(
+                    (order, pattern, li))
+            elif format == "regex":
+                if self._is_anchored_regex(pattern):
+                    key = (start, pattern.flags)
+                else:
+                    key = (start, pattern.flags, order)
+                regexes.setdefault(key, []).append((order, pattern, li))
+            else:  # a struct format
+                try:
+                    length = struct.calcsize(format)
+                except struct.error, ex:
+                    warnings.warn("error in %s magic number struct format: %r"
+                                      % (li, format),
+                                  InvalidLangInfoWarning)
+                    continue
+                hit_from_value = structs.setdefault(
+                    (start, format), (length, {}))[1]
+                hit_from_value.setdefault(pattern, (order, li))
+
+        for start, entries in self._strings_from_start.items():
+            key_len = min(len(pattern) for order, pattern, li in entries)
+            entries_from_key = {}
+            for order, pattern, li in entries:
+                entries_from_key.setdefault(pattern[:key_len], []).append(
+                    (order, start + len(pattern), pattern, li))
+            self._strings_from_start[start] = (key_len, entries_from_key)
+
+        for (start, format), (length, hit_from_value) in structs.items():
+            self._structs.append((start, length, format, hit_from_value))
+
+        for key, entries in regexes.items():
+            start, flags = key[:2]
+            if len(entries) > 1:
+                try:
+                    regex = re.compile('|'.join(
+                        "(?P<m%d>%s)" % (order, regex.pattern)
+                        for order, regex, li in entries), flags)
+                except re.error:
+                    # E.g. the same group name used in two of them.
+                    pass
+                else:
+                    hit_from_group = dict(("m%d" % order, (order, li))
+                                          for order, regex, li in entries)
+                    # Anchored, so `match` is equivalent to `search` but
+                    # doesn't try every position.
+                    self._regexes.append(
+                        (entries[0][0], start, regex.match, hit_from_group))
+                    continue
+            for order, regex, li in entries:
+                self._regexes.append(
+                    (order, start, regex.search, {None: (order, li)}))
+        self._regexes.sort(key=operator.itemgetter(0))
+
+    def _is_anchored_regex(self, regex):
+        """Return true iff the given regex can only match at the start
+        of the string.
+
+        Merging such regexes into one alternation is safe: the leftmost
+        match of the alternation is then always from the first matching
+        alternative. A regex with backreferences isn't merged because
+        its group numbers would change.
+        """
+        import sre_parse
+        from sre_constants import AT, AT_BEGINNING, AT_BEGINNING_STRING
+        if re.search(r"\\[1-9]|\(\?P=|\(\?\(", regex.pattern):
+            return False
+        try:
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+        except re.error:
+            return False
+        if not len(parsed):
+            return False
+        op, av = parsed[0]
+        return op == AT and (av == AT_BEGINNING_STRING
+            or (av == AT_BEGINNING and not regex.flags & re.MULTILINE))
+
+    def match(self, head_bytes, shebang_only=False):
+        """Return the first LangInfo in the table whose magic number
+        matches the given head bytes, or None.
+        """
+        best = None  # (<order>, <langinfo>)
+        if not shebang_only:
+            for start, (key_len, entries_from_key) \
+                    in self._strings_from_start.items():
+                entries = entries_from_key.get(
+                    head_bytes[start:start+key_len])
+                if not entries:
+                    continue
+                for order, end, pattern, li in entries:
+                    if best is not None and order >= best[0]:
+                        break
+                    if head_bytes[start:end] == pattern:
+                        best = (order, li)
+                        break
+            for start, length, format, hit_from_value in self._structs:
+                bytes = head_bytes[start:start+length]
+                if len(bytes) == length:
+                    hit = hit_from_value.get(struct.unpack(format, bytes)[0])
+                    if hit is not None and (best is None or hit < best):
+                        best = hit
+        for min_order, start, matcher, hit_from_group in self._regexes:
+            if best is not None and min_order >= best[0]:
+                break
+            match = matcher(head_bytes, start)
+            if match:
+                if len(hit_from_group) == 1:
+                    hit = hit_from_group.values()[0]
+                else:
+                    hit = hit_from_group[match.lastgroup]
+                if best is None or hit < best:
+                    best = hit
+        if best is not None:
+            return best[1]
+
+
+class _SpecializationMatcher(object):
+    """Checks a base language's specialization hints against some text
+    in one pass over it.
+
+    A hint is a `(<hint-str>, <hint-regex-or-None>)` tuple. It matches if
+    the string is in the text and, if given, the regex also matches. A
+    single alternation of the hint strings is used to find where any of
+    them occur, and a hint's regex is only tried once its string has been
+    found.
+
+    `hits[i]` counts the times hint i was the one to specialize a text
+    and `regex_misses[i]` the times its string was found but its regex
+    didn't match (i.e. a wasted regex search). These are for tuning the
+    hints.
+    """
+    def __init__(self, hints):
+        self.hints = hints
+        self.hits = [0] * len(hints)
+        self.regex_misses = [0] * len(hints)
+        self._indices_from_str = {}
+        for i, (hint_str, hint_re) in enumerate(hints):
+            self._indices_from_str.setdefault(hint_str, []).append(i)
+        self._all_strs_regex = self._str_regex(self._indices_from_str)
+
+    def _str_regex(self, strs):
+        # Longest first, in case one string is a prefix of another.
+        strs = sorted(strs, key=len, reverse=True)
+        return re.compile('|'.join(re.escape(s) for s in strs))
+
+    def match(self, text, window=None):
+        """Return true iff any of the hints match the given text.
+
+        @param window {int} if given, only this many chars at the start
+            of the text are searched.
+        """
+        endpos = len(text)
+        if window is not None and window < endpos:
+            endpos = window
+        indices_from_str = self._indices_from_str.copy()
+        str_regex = self._all_strs_regex
+        pos = 0
+        while indices_from_str:
+            match = str_regex.search(text, pos, endpos)
+            if not match:
+                break
+            pos = match.start()
+            # Check all strings found here, not just the one that matched.
+            for hint_str in [s for s in indices_from_str
+                             if text.startswith(s, pos, endpos)]:
+                for i in indices_from_str.pop(hint_str):
+                    hint_re = self.hints[i][1]
+                    if hint_re is None or hint_re.search(text, 0, endpos):
+                        self.hits[i] += 1
+                        return True
+                    self.regex_misses[i] += 1
+                str_regex = self._str_regex(indices_from_str)
+            pos += 1
+        return False
+
+
 #---- the Database
 
 class Database(object):
     def __init__(self, dirs=None):
+        self._init_attrs()
+
+        self._load()
+        if dirs is None:
+            dirs = []
+        dirs.insert(0, dirname(__file__) or os.curdir)
+        for dir in dirs:
+            self._load_dir(dir)
+        self.dirs = dirs
+
+    def _init_attrs(self):
         self._langinfo_from_norm_lang = {}
         self._langinfo_from_ext = None
         self._langinfo_from_filename = None
         self._langinfo_from_filename_re = None
         self._magic_table = None
+        self._magic_matcher = None
         self._li_from_doctype_public_id = None
         self._li_from_doctype_system_id = None
         self._li_from_emacs_mode = None
         self._li_from_vi_filetype = None
         self._li_from_norm_komodo_lang = None
+        self._specialization_matcher_from_lang = {}
+        self._conformance_from_li = None
+        self._module_paths = []
+        # `langinfo_*.py` modules that could not be imported
+        self._failed_module_paths = []
 
-        self._load()
-        if dirs is None:
-            dirs = []
-        dirs.insert(0, dirname(__file__) or os.curdir)
-        for dir in dirs:
-            self._load_dir(dir)
-        self.dirs = dirs
+    _version = None
+    @property
+    def version(self):
+        """A string identifying the content of this database.
+
+        This changes if any of the loaded `langinfo_*.py` modules (or
+        this module) change, so it can be used to invalidate data
+        derived from classification with this database.
+        """
+        if self._version is None:
+            from hashlib import md5
+            digest = md5(__version__)
+            for path in [__file__] + self._module_paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                digest.update("%s:%d:%r" % (abspath(path), st.st_size,
+                                            st.st_mtime))
+            self._version = digest.hexdigest()
+        return self._version
 
     def langinfos(self):
         for li in self._langinfo_from_norm_lang.values():
@@ -369,34 +672,9 @@ class Database(object):
         """
         if self._magic_table is None:
             self._build_tables()
-
-        for magic_number, li, sort_key in self._magic_table:
-            try:
-                start, format, pattern = magic_number
-            except ValueError:
-                # Silently drop bogus magic number decls.
-                continue
-            if shebang_only and format != "regex":
-                continue
-            if format == "string":
-                end = start + len(pattern)
-                if head_bytes[start:end] == pattern:
-                    return li
-            elif format == "regex":
-                if pattern.search(head_bytes, start):
-                    return li
-            else:  # a struct format
-                try:
-                    length = struct.calcsize(format)
-                except struct.error, ex:
-                    warnings.warn("error in %s magic number struct format: %r"
-                                      % (li, format),
-                                  InvalidLangInfoWarning)
-                end = start + length
-                bytes = head_bytes[start:end]
-                if len(bytes) == length:
-                    if struct.unpack(format, bytes)[0] == pattern:
-                        return li
+        if self._magic_matcher is None:
+            self._magic_matcher = _MagicMatcher(self._magic_table)
+        return self._magic_matcher.match(head_bytes, shebang_only)
 
     def langinfo_from_doctype(self, public_id=None, system_id=None):
         """Return a LangInfo instance matching any of the specified
@@ -423,30 +701,59 @@ class Database(object):
            and system_id in self._li_from_doctype_system_id:
             return self._li_from_doctype_system_id[system_id]
 
-    def specialized_langinfo_from_content(self, li, text):
+    def specialized_langinfo_from_content(self, li, text, window=None):
+        """Return a LangInfo specializing the given one (e.g. "Django
+        HTML Template" for "HTML") if its specialization hints match the
+        given text, else None.
+
+        @param window {int} can be given to only search the first
+            `window` chars of the text, bounding the cost for large
+            texts at the risk of missing a hint further in.
+        """
         hints, specialized_li = self._specialization_hints_from_lang.get(
             li.name, (None, None))
         if not hints:
             return None
-        for hint_str, hint_re in hints:
-            if hint_str not in text:
-                continue
-            if hint_re and not hint_re.search(text):
-                continue
+        matcher = self._specialization_matcher_from_lang.get(li.name)
+        if matcher is None:
+            matcher = _SpecializationMatcher(hints)
+            self._specialization_matcher_from_lang[li.name] = matcher
+        if matcher.match(text, window):
             return specialized_li
         return None
 
+    def specialization_hint_hits(self):
+        """Return hit counts for the specialization hints used so far by
+        `specialized_langinfo_from_content()`, for tuning the hints.
+
+        The returned dict maps `(<base-lang>, <hint-str>)` to
+        `(<hits>, <regex-misses>)`: the number of times the hint
+        specialized a text and the number of times its string was found
+        but its regex didn't match.
+        """
+        hits_from_hint = {}
+        for lang, matcher in self._specialization_matcher_from_lang.items():
+            for i, (hint_str, hint_re) in enumerate(matcher.hints):
+                hits, regex_misses = hits_from_hint.get((lang, hint_str),
+                                                        (0, 0))
+                hits_from_hint[(lang, hint_str)] = (
+                    hits + matcher.hits[i],
+                    regex_misses + matcher.regex_misses[i])
+        return hits_from_hint
+
     def _build_tables(self):
         self._langinfo_from_ext = {}
         self._langinfo_from_filename = {}
         self._langinfo_from_filename_re = {}
         self._magic_table = []  # list of (<magic-tuple>, <langinfo>, <sort-key>)
+        self._magic_matcher = None  # built from `_magic_table` on first use
         self._li_from_doctype_public_id = {}
         self._li_from_doctype_system_id = {}
         self._li_from_emacs_mode = {}
         self._li_from_vi_filetype = {}
         self._li_from_norm_komodo_lang = {}
         self._specialization_hints_from_lang = {} # <lang> -> (<hint>, <specialized-langinfo>)
+        self._specialization_matcher_from_lang = {} # built on first use
 
         for li in self._langinfo_from_norm_lang.values():
             if li.exts:
@@ -517,15 +824,259 @@ class Database(object):
                     self._specialization_hints_from_lang[lang] = (hint, li)
         
         self._magic_table.sort(key=operator.itemgetter(2))
+        self._build_conformance_table()
+
+    def _build_conformance_table(self):
+        # Called from `_build_tables()`, so this is redone when a
+        # fallback langinfo is added in `langinfo_from_komodo_lang()`.
+        self._conformance_from_li = {}
+        for li in self._langinfo_from_norm_lang.values():
+            self._conformance(li)
+
+    def _conformance(self, li):
+        """Return conformance info for the given langinfo, computing it
+        the first time.
+
+        The returned tuple is `(<conforms-to>, <conformance-order>,
+        <conformant-attrs>)`, where <conforms-to> is the frozenset of
+        names of all languages `li` (transitively) conforms to, including
+        its own; <conformance-order> is the tuple of langinfos in which
+        `LangInfo.conformant_attr()` looks for an attribute (`li` first,
+        then its bases depth-first); and <conformant-attrs> is a dict
+        caching the resolved values for `conformant_attr()`.
+        """
+        if self._conformance_from_li is None:
+            self._build_conformance_table()
+        try:
+            return self._conformance_from_li[li]
+        except KeyError:
+            pass
+        conforms_to = set()
+        conformance_order = []
+        def add(li):
+            if li in conformance_order:
+                return
+            conformance_order.append(li)
+            conforms_to.add(li.name)
+            for base in li.conforms_to_bases or []:
+                conforms_to.add(base)
+                try:
+                    base_li = self.langinfo_from_lang(base)
+                except LangInfoError:
+                    pass
+                else:
+                    add(base_li)
+        add(li)
+        conformance = (frozenset(conforms_to), tuple(conformance_order), {})
+        self._conformance_from_li[li] = conformance
+        return conformance
 
     def _norm_lang_from_lang(self, lang):
         return lang.lower()
 
+    #---- snapshot support
+    # A snapshot is a pickle of the built tables and of the core
+    # attributes of each LangInfo (see `_SnapshotLangInfo`), so that
+    # loading it doesn't need to import the `langinfo_*.py` modules.
+
+    _SNAPSHOT_FORMAT = 1
+
+    @classmethod
+    def from_snapshot(cls, dirs=None, path=None):
+        """Load a database from a snapshot written by `save_snapshot()`.
+
+        Returns None if there is no snapshot, or if it is stale: i.e.
+        if it was built for other dirs or if any of the `langinfo*.py`
+        modules have since been added, removed or changed.
+        """
+        import cPickle
+        dirs = [abspath(d) for d in
+                [dirname(__file__) or os.curdir] + list(dirs or [])]
+        if path is None:
+            path = _snapshot_path()
+        try:
+            fin = open(path, 'rb')
+        except EnvironmentError:
+            return None
+        try:
+            try:
+                snapshot = cPickle.load(fin)
+            except Exception, ex:
+                log.debug("could not load langinfo snapshot `%s': %s",
+                          path, ex)
+                return None
+        finally:
+            fin.close()
+
+        if snapshot.get("format") != cls._SNAPSHOT_FORMAT \
+           or snapshot.get("version") != __version__ \
+           or snapshot.get("dirs") != dirs:
+            log.debug("langinfo snapshot `%s' is for a different database",
+                      path)
+            return None
+        module_infos = snapshot["module_infos"]
+        module_paths = [p for p, size, mtime, digest in module_infos[1:]]
+        failed_module_infos = snapshot.get("failed_module_infos", [])
+        failed_module_paths = [p for p, size, mtime, digest
+                               in failed_module_infos]
+        if sorted(module_paths + failed_module_paths) \
+           != sorted(cls._module_paths_from_dirs(dirs)):
+            log.debug("langinfo snapshot `%s' is stale: module set changed",
+                      path)
+            return None
+        for module_info in module_infos + failed_module_infos:
+            if not _is_module_info_current(module_info):
+                log.debug("langinfo snapshot `%s' is stale: `%s' changed",
+                          path, module_info[0])
+                return None
+
+        self = cls.__new__(cls)
+        self._init_attrs()
+        self.dirs = dirs
+        self._module_paths = module_paths
+        self._failed_module_paths = failed_module_paths
+        li_from_name = {}
+        for li_data in snapshot["langinfos"]:
+            li = _SnapshotLangInfo(self, *li_data)
+            li_from_name[li.name] = li
+            self._langinfo_from_norm_lang[
+                self._norm_lang_from_lang(li.name)] = li
+        for li in li_from_name.values():
+            # `is_minor_variant` is stored as the name of the langinfo.
+            if "is_minor_variant" in li.__dict__:
+                li.is_minor_variant = li_from_name[li.is_minor_variant]
+
+        def li_dict(names_from_key):
+            return dict((k, li_from_name[n])
+                        for k, n in names_from_key.items())
+        tables = snapshot["tables"]
+        self._langinfo_from_ext = li_dict(tables["ext"])
+        self._langinfo_from_filename = li_dict(tables["filename"])
+        self._langinfo_from_filename_re = dict(
+            (regex, li_from_name[n]) for regex, n in tables["filename_re"])
+        self._magic_table = [(mn, li_from_name[n], sort_key)
+                             for mn, n, sort_key in tables["magic"]]
+        self._li_from_doctype_public_id = li_dict(tables["doctype_public_id"])
+        self._li_from_doctype_system_id = li_dict(tables["doctype_system_id"])
+        self._li_from_emacs_mode = li_dict(tables["emacs_mode"])
+        self._li_from_vi_filetype = li_dict(tables["vi_filetype"])
+        self._li_from_norm_komodo_lang = li_dict(tables["norm_komodo_lang"])
+        self._specialization_hints_from_lang = dict(
+            (lang, (hints, li_from_name[n]))
+            for lang, (hints, n) in tables["specialization_hints"].items())
+        return self
+
+    def save_snapshot(self, path=None):
+        """Save a snapshot of this database for `from_snapshot()`.
+
+        Returns True if the snapshot was written. Errors writing it
+        (e.g. no write permission) are logged and otherwise ignored.
+        """
+        import cPickle
+        from tempfile import mkstemp
+        if path is None:
+            path = _snapshot_path()
+        if self._magic_table is None:
+            self._build_tables()
+
+        langinfos = []
+        for li in self._langinfo_from_norm_lang.values():
+            if isinstance(li, _SnapshotLangInfo):
+                module_path, class_name = li._module_path, li._class_name
+            else:
+                module = sys.modules.get(li.__class__.__module__)
+                class_name = li.__class__.__name__
+                if getattr(module, class_name, None) is not li.__class__ \
+                   or not getattr(module, "__file__", None):
+                    # E.g. a fallback langinfo for a Komodo language.
+                    # These are re-created as needed.
+                    continue
+                module_path = _source_path(module.__file__)
+            attrs = {}
+            for attr in _SnapshotLangInfo.snapshot_attrs:
+                if attr == "is_minor_variant":
+                    variant = getattr(li, attr, None)
+                    if variant is not None:
+                        attrs[attr] = variant.name
+                elif hasattr(li, attr):
+                    value = getattr(li, attr)
+                    if value is not None:
+                        attrs[attr] = _lazy_regexes_from_value(value)
+            langinfos.append((module_path, class_name, attrs))
+
+        def name_dict(li_from_key):
+            return dict((k, li.name) for k, li in li_from_key.items())
+        tables = {
+            "ext": name_dict(self._langinfo_from_ext),
+            "filename": name_dict(self._langinfo_from_filename),
+            "filename_re": [(_lazy_regexes_from_value(regex), li.name)
+                for regex, li in self._langinfo_from_filename_re.items()],
+            "magic": [(_lazy_regexes_from_value(mn), li.name, sort_key)
+                      for mn, li, sort_key in self._magic_table],
+            "doctype_public_id": name_dict(self._li_from_doctype_public_id),
+            "doctype_system_id": name_dict(self._li_from_doctype_system_id),
+            "emacs_mode": name_dict(self._li_from_emacs_mode),
+            "vi_filetype": name_dict(self._li_from_vi_filetype),
+            "norm_komodo_lang": name_dict(self._li_from_norm_komodo_lang),
+            "specialization_hints": dict(
+                (lang, (_lazy_regexes_from_value(hints), li.name))
+                for lang, (hints, li)
+                in self._specialization_hints_from_lang.items()),
+        }
+        failed_module_infos = []
+        for p in self._failed_module_paths:
+            try:
+                failed_module_infos.append(_module_info_from_path(abspath(p)))
+            except EnvironmentError:
+                pass  # then the snapshot is treated as stale
+        snapshot = {
+            "format": self._SNAPSHOT_FORMAT,
+            "version": __version__,
+            "dirs": [abspath(d) for d in self.dirs],
+            "module_infos": [_module_info_from_path(abspath(p)) for p in
+                             [_source_path(__file__)] + self._module_paths],
+            # Recorded so that they don't make the snapshot look stale
+            # until they change.
+            "failed_module_infos": failed_module_infos,
+            "langinfos": langinfos,
+            "tables": tables,
+        }
+
+        try:
+            fd, tmp_path = mkstemp(".tmp", "langinfo-snapshot-",
+                                   dirname(path) or os.curdir)
+            fout = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(snapshot, fout, 2)
+            finally:
+                fout.close()
+            # `mkstemp()` creates the file readable only by this user, but
+            # the snapshot of a shared install is used by all users.
+            os.chmod(tmp_path, 0644)
+            if sys.platform == "win32" and exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except EnvironmentError, ex:
+            log.debug("could not save langinfo snapshot `%s': %s", path, ex)
+            return False
+        return True
+
+    @staticmethod
+    def _module_paths_from_dirs(dirs):
+        """The `langinfo_*.py` modules that `_load_dir()` loads for the
+        given dirs.
+        """
+        paths = []
+        for d in dirs:
+            paths += [abspath(p) for p in glob(join(d, "langinfo_*.py"))]
+        return paths
+
     def _load(self):
         """Load LangInfo classes in this module."""
         for name, g in globals().items():
-            if isinstance(g, (types.ClassType, types.TypeType)) \
-               and issubclass(g, LangInfo) and g is not LangInfo:
+            if (not name.startswith("_")   # skip internal bases
+                and isinstance(g, (types.ClassType, types.TypeType))
+                and issubclass(g, LangInfo) and g is not LangInfo):
                 norm_lang = self._norm_lang_from_lang(g.name)
                 self._langinfo_from_norm_lang[norm_lang] = g(self)
 
@@ -538,7 +1089,9 @@ class Database(object):
                 log.warn("could not import `%s': %s", path, ex)
                 #import traceback
                 #traceback.print_exc()
+                self._failed_module_paths.append(path)
                 continue
+            self._module_paths.append(path)
             for name in dir(module):
                 attr = getattr(module, name)
                 if (not name.startswith("_")   # skip internal bases
@@ -560,11 +1113,64 @@ def set_default_dirs(dirs):
         _g_default_database = None
 
 def get_default_database():
-    global _g_default_database, _g_default_database
+    """Return the default langinfo Database.
+
+    This is loaded from a snapshot of the database if there is a
+    current one (see `Database.from_snapshot()`). Otherwise the database
+    is built from the `langinfo_*.py` modules and a new snapshot saved.
+    """
+    global _g_default_database
     if _g_default_database is None:
-        _g_default_database = Database(dirs=_g_default_dirs)
+        db = Database.from_snapshot(dirs=_g_default_dirs)
+        if db is None:
+            db = Database(dirs=list(_g_default_dirs or []))
+            db.save_snapshot()
+        _g_default_database = db
     return _g_default_database
 
+def _snapshot_path():
+    """The default path of the langinfo Database snapshot."""
+    return join(dirname(__file__) or os.curdir, "langinfo.snapshot")
+
+def _source_path(path):
+    if path.endswith((".pyc", ".pyo")):
+        return path[:-1]
+    return path
+
+def _module_info_from_path(path):
+    """Return (<path>, <size>, <mtime>, <md5-hexdigest>) for a module,
+    used to check if a snapshot is current.
+    """
+    from hashlib import md5
+    st = os.stat(path)
+    fin = open(path, 'rb')
+    try:
+        digest = md5(fin.read()).hexdigest()
+    finally:
+        fin.close()
+    return (path, st.st_size, st.st_mtime, digest)
+
+def _is_module_info_current(module_info):
+    """Return True iff the given module info (see
+    `_module_info_from_path()`) is still current.
+    
+    The size and mtime are checked first. If the mtime has changed
+    (e.g. from a fresh checkout), the content hash is compared.
+    """
+    path, size, mtime, digest = module_info
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_size != size:
+        return False
+    if st.st_mtime == mtime:
+        return True
+    try:
+        return _module_info_from_path(path)[3] == digest
+    except EnvironmentError:
+        return False
+
 # Recipe: module_from_path (1.0.1+)
 def _module_from_path(path):
     import imp, os
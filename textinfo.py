@@ -139,8 +139,10 @@ import logging
 import optparse
 import codecs
 import locale
+from array import array
 
 import langinfo
+from fileutils import regex_from_glob_patterns
 
 
 
@@ -165,6 +167,12 @@ log = logging.getLogger("textinfo")
 # For debugging:
 DEBUG_CHARDET_INFO = False  # gather chardet info
 
+_NOT_SPECIFIED = ("NOT", "SPECIFIED")
+
+# Number of paths handed to a worker process at a time by
+# `textinfo_from_paths()`.
+_TEXTINFO_JOB_CHUNKSIZE = 16
+
 
 
 #---- module API
@@ -177,15 +185,83 @@ def textinfo_from_filename(path):
     return TextInfo.init_from_filename(path)
 
 def textinfo_from_path(path, encoding=None, follow_symlinks=False,
-                       quick_determine_lang=False):
+                       quick_determine_lang=False, cache=None):
     """Determine text info for the given path.
     
     This raises EnvironmentError if the path doesn't not exist or could
     not be read.
     """
-    return TextInfo.init_from_path(path, encoding=encoding, 
+    return TextInfo.init_from_path(path, encoding=encoding,
                                    follow_symlinks=follow_symlinks,
-                                   quick_determine_lang=quick_determine_lang)
+                                   quick_determine_lang=quick_determine_lang,
+                                   cache=cache)
+
+def textinfo_from_paths(paths, encoding=None, follow_symlinks=False,
+                        quick_determine_lang=False, jobs=1, ordered=True,
+                        on_error=_NOT_SPECIFIED, cache=None):
+    """Generate text info for each of the given paths.
+
+    @param paths {iterable} of paths to classify. This can be a
+        generator, e.g. from `_paths_from_path_patterns()`. Items can
+        also be (<path>, <stat-result>) tuples to save stat'ing paths
+        again (see `TextInfo.init_from_path()`).
+    @param jobs {int} is the number of worker processes to spread the
+        classification across. The default (1) classifies in this
+        process. Use 0 for one worker per CPU.
+    @param ordered {boolean} can be set to False to have results yielded
+        as soon as they are ready instead of in the order of `paths`.
+        Only relevant if `jobs` is not 1.
+    @param on_error {callable} is called as `on_error(path, ex)` for a
+        path that could not be stat'd or read. If not specified the
+        EnvironmentError is raised. Specify None to skip such paths
+        silently.
+    @param cache {TextInfoCache} An optional persistent classification
+        cache. Worker processes each open their own connection to the
+        same cache file, so the `hits` and `misses` counters of the
+        given cache only count in-process lookups.
+
+    Each worker process reuses a single langinfo Database for all of the
+    paths it classifies.
+    """
+    if jobs == 1:
+        results = (_textinfo_from_path_job(
+                        (path, encoding, follow_symlinks, quick_determine_lang),
+                        cache)
+                   for path in paths)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs or None,
+                    _init_textinfo_worker,
+                    (langinfo._g_default_dirs, cache and cache.path))
+        job_args = ((path, encoding, follow_symlinks, quick_determine_lang)
+                    for path in paths)
+        if ordered:
+            results = pool.imap(_textinfo_from_path_worker_job, job_args,
+                                _TEXTINFO_JOB_CHUNKSIZE)
+        else:
+            results = pool.imap_unordered(_textinfo_from_path_worker_job,
+                                          job_args, _TEXTINFO_JOB_CHUNKSIZE)
+    finished = False
+    try:
+        for path, ti, ex in results:
+            if ex is None:
+                yield ti
+            elif on_error is _NOT_SPECIFIED:
+                raise ex
+            elif on_error is not None:
+                on_error(path, ex)
+        finished = True
+    finally:
+        if pool is not None:
+            if finished:
+                # Let workers exit normally so they flush their caches.
+                pool.close()
+            else:
+                # Stop any outstanding work if the caller stopped iterating
+                # early (or an error was raised).
+                pool.terminate()
+            pool.join()
 
 
 
@@ -225,7 +301,7 @@ class TextInfo(object):
     def init_from_path(cls, path, encoding=None, lidb=None,
                        follow_symlinks=False,
                        quick_determine_lang=False,
-                       env=None):
+                       env=None, cache=None, stat=None):
         """Create an instance using the filename and stat/read info
         from the given path to initialize.
 
@@ -239,12 +315,23 @@ class TextInfo(object):
             whose behaviour is used to influence processing. Currently
             it is just used to provide a hook for lang determination
             by filename (for Komodo).
+        @param cache {TextInfoCache} An optional persistent cache of
+            classification results. On a cache hit no I/O other than a
+            stat of the path is done. Note that `text` is not set for
+            a textinfo loaded from the cache. The cache is not used
+            if `env` is given.
+        @param stat {stat result} The result of `os.stat()` (or
+            `os.lstat()` if `follow_symlinks` is false) for the path,
+            if the caller already has it, e.g. from a dir walk.
         """
         if lidb is None:
             lidb = langinfo.get_default_database()
+        if env is not None:
+            cache = None
         self = cls()
         self.path = path
-        self._accessor = PathAccessor(path, follow_symlinks=follow_symlinks)
+        self._accessor = PathAccessor(path, follow_symlinks=follow_symlinks,
+                                      stat=stat)
         try:
             #TODO: pref: Is a preference specified for this path?
 
@@ -252,37 +339,74 @@ class TextInfo(object):
             if self.file_type_name != "regular file":
                 # Don't continue if not a regular file.
                 return self
-
-            #TODO: add 'pref:treat_as_text' a la TextMate (or
-            #      perhaps that is handled in _classify_from_filename())
-
-            self._classify_from_filename(lidb, env)
-            if self.is_text is False:
-                return self
-            if self.lang and quick_determine_lang:
-                return self
-
-            if not self.lang:
-                self._classify_from_magic(lidb)
-                if self.is_text is False:
+            if self.file_stat.st_size >= MmapPathAccessor.MIN_SIZE:
+                self._accessor = MmapPathAccessor(path,
+                    follow_symlinks=follow_symlinks, stat=self.file_stat)
+
+            if cache is not None:
+                cached_info = cache.get(path, self.file_stat, lidb, encoding)
+                if cached_info is not None:
+                    self._init_from_cached_info(cached_info, lidb)
                     return self
-            if self.lang and quick_determine_lang:
-                return self
 
-            self._classify_encoding(lidb, suggested_encoding=encoding)
-            if self.is_text is None and self.encoding:
-                self.is_text = True
-            if self.is_text is False:
-                return self
-            self.text = self._accessor.text
-
-            if self.text:  # No `self.text' with current UTF-32 hack.
-                self._classify_from_content(lidb)
+            self._classify_from_path(lidb, encoding, quick_determine_lang,
+                                     env)
+            if cache is not None and not quick_determine_lang:
+                cache.put(path, self.file_stat, lidb, encoding,
+                          self._cached_info())
             return self
         finally:
             # Free the memory used by the accessor.
             del self._accessor 
 
+    def _classify_from_path(self, lidb, encoding, quick_determine_lang, env):
+        """Classify a regular file from its filename and content."""
+        #TODO: add 'pref:treat_as_text' a la TextMate (or
+        #      perhaps that is handled in _classify_from_filename())
+
+        self._classify_from_filename(lidb, env)
+        if self.is_text is False:
+            return
+        if self.lang and quick_determine_lang:
+            return
+
+        if not self.lang:
+            self._classify_from_magic(lidb)
+            if self.is_text is False:
+                return
+        if self.lang and quick_determine_lang:
+            return
+
+        self._classify_encoding(lidb, suggested_encoding=encoding)
+        if self.is_text is None and self.encoding:
+            self.is_text = True
+        if self.is_text is False:
+            return
+        self.text = self._accessor.text
+
+        if self.text:  # No `self.text' with current UTF-32 hack.
+            self._classify_from_content(lidb)
+
+    # The attributes stored in a `TextInfoCache` for a classified path.
+    _cached_attrs = ("lang", "encoding", "has_bom", "is_text",
+                     "encoding_bozo", "encoding_bozo_reasons",
+                     "has_xml_prolog", "xml_version", "xml_encoding",
+                     "has_doctype_decl", "doctype_decl", "doctype_name",
+                     "doctype_public_id", "doctype_system_id",
+                     "emacs_vars", "vi_vars")
+
+    def _cached_info(self):
+        return dict((attr, self.__dict__[attr]) for attr in self._cached_attrs
+                    if attr in self.__dict__)
+
+    def _init_from_cached_info(self, cached_info, lidb):
+        self.__dict__.update(cached_info)
+        if self.lang:
+            try:
+                self.langinfo = lidb.langinfo_from_lang(self.lang)
+            except langinfo.LangInfoError:
+                pass
+
     def __repr__(self):
         if self.path:
             return "<TextInfo %r>" % self.path
@@ -290,6 +414,24 @@ class TextInfo(object):
             return "<TextInfo %r>"\
                    % _one_line_summary_from_text(self.content, 30)
 
+    def __getstate__(self):
+        # A LangInfo references its whole langinfo Database, so only the
+        # lang name is pickled (e.g. when results are passed back from
+        # `textinfo_from_paths()` worker processes).
+        state = self.__dict__.copy()
+        state.pop("_accessor", None)
+        state.pop("langinfo", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.lang:
+            try:
+                self.langinfo = langinfo.get_default_database() \
+                    .langinfo_from_lang(self.lang)
+            except langinfo.LangInfoError:
+                pass
+
     def as_dict(self):
         return dict((k,v) for k,v in self.__dict__.items()
                     if not k.startswith('_'))
@@ -474,7 +616,7 @@ class TextInfo(object):
            charset, if any.
         7. Emacs-style "coding" local var.
         8. Vi[m]-style "fileencoding" local var.
-        9. Heuristic checks for UTF-16 without BOM.
+        9. Heuristic checks for UTF-16 and UTF-32 without BOM.
         10. Give UTF-8 a try, it is a pretty common fallback.
             We must do this before a possible 8-bit
             `locale.getpreferredencoding()` because any UTF-8 encoded
@@ -517,6 +659,15 @@ class TextInfo(object):
                          % (bom_encoding, self._accessor))
 
         head_bytes = self._accessor.head_bytes
+        byte_stats = self._get_byte_stats()
+        if (not self.has_bom and self.langinfo is None
+            and suggested_encoding is None
+            and byte_stats.is_obviously_binary):
+            log.debug("%s is obviously binary: %r", self._accessor,
+                      byte_stats)
+            self.is_text = False
+            return
+
         if DEBUG_CHARDET_INFO:
             sys.path.insert(0, os.path.expanduser("~/tm/check/contrib/chardet"))
             import chardet
@@ -536,8 +687,7 @@ class TextInfo(object):
         # 3. Check for EBCDIC.
         #TODO: Not sure this should be included, chardet may be better
         #      at this given different kinds of EBCDIC.
-        EBCDIC_MAGIC = '\x4c\x6f\xa7\x94'
-        if self._accessor.head_4_bytes == EBCDIC_MAGIC:
+        if byte_stats.head_is_ebcdic:
             # This is EBCDIC, but I don't know if there are multiple kinds
             # of EBCDIC. Python has a 'ebcdic-cp-us' codec. We'll use
             # that for now.
@@ -606,9 +756,11 @@ class TextInfo(object):
                          % (norm_http_encoding, self._accessor))
 
         # 7. Emacs-style local vars.
-        emacs_head_vars = self._get_emacs_head_vars(head_bytes)
-        emacs_encoding = emacs_head_vars.get("coding")
-        if not emacs_encoding:
+        emacs_encoding = None
+        if byte_stats.head_has_emacs_vars:
+            emacs_head_vars = self._get_emacs_head_vars(head_bytes)
+            emacs_encoding = emacs_head_vars.get("coding")
+        if not emacs_encoding and byte_stats.tail_has_emacs_vars:
             tail_bytes = self._accessor.tail_bytes
             emacs_tail_vars = self._get_emacs_tail_vars(tail_bytes)
             emacs_encoding = emacs_tail_vars.get("coding")
@@ -627,9 +779,11 @@ class TextInfo(object):
                      % (norm_emacs_encoding, self._accessor))
 
         # 8. Vi[m]-style local vars.
-        vi_vars = self._get_vi_vars(head_bytes)
-        vi_encoding = vi_vars.get("fileencoding") or vi_vars.get("fenc")
-        if not vi_encoding:
+        vi_encoding = None
+        if byte_stats.head_has_vi_vars:
+            vi_vars = self._get_vi_vars(head_bytes)
+            vi_encoding = vi_vars.get("fileencoding") or vi_vars.get("fenc")
+        if not vi_encoding and byte_stats.tail_has_vi_vars:
             vi_vars = self._get_vi_vars(self._accessor.tail_bytes)
             vi_encoding = vi_vars.get("fileencoding") or vi_vars.get("fenc")
         if vi_encoding:
@@ -646,47 +800,18 @@ class TextInfo(object):
                     u"Vi[m] coding var (%s) could not decode %s"
                      % (norm_vi_encoding, self._accessor))
 
-        # 9. Heuristic checks for UTF-16 without BOM.
-        utf16_encoding = None
-        head_odd_bytes  = head_bytes[0::2]
-        head_even_bytes = head_bytes[1::2]
-        head_markers = ["<?xml", "#!"]
-        for head_marker in head_markers:
-            length = len(head_marker)
-            if head_odd_bytes.startswith(head_marker) \
-               and head_even_bytes[0:length] == '\x00'*length:
-                utf16_encoding = "utf-16-le"
-                break
-            elif head_even_bytes.startswith(head_marker) \
-               and head_odd_bytes[0:length] == '\x00'*length:
-                utf16_encoding = "utf-16-be"
-                break
-        internal_markers = ["coding"]
-        for internal_marker in internal_markers:
-            length = len(internal_marker)
-            try:
-                idx = head_odd_bytes.index(internal_marker)
-            except ValueError:
-                pass
-            else:
-                if head_even_bytes[idx:idx+length] == '\x00'*length:
-                    utf16_encoding = "utf-16-le"
-            try:
-                idx = head_even_bytes.index(internal_marker)
-            except ValueError:
-                pass
-            else:
-                if head_odd_bytes[idx:idx+length] == '\x00'*length:
-                    utf16_encoding = "utf-16-be"
-        if utf16_encoding:
-            if self._accessor.decode(utf16_encoding):
-                log.debug("encoding: guessed encoding: %r", utf16_encoding)
-                self.encoding = utf16_encoding
+        # 9. Heuristic checks for UTF-16 and UTF-32 without BOM.
+        utf_encoding = byte_stats.bomless_utf_encoding
+        if utf_encoding:
+            if self._accessor.decode(utf_encoding):
+                log.debug("encoding: guessed encoding: %r", utf_encoding)
+                self.encoding = utf_encoding
                 return
 
         # 10. Give UTF-8 a try.
         norm_utf8_encoding = _norm_encoding("utf-8")
-        if self._accessor.decode(norm_utf8_encoding):
+        if byte_stats.head_is_utf8 \
+           and self._accessor.decode(norm_utf8_encoding):
             log.debug("UTF-8 encoding: %r", norm_utf8_encoding)
             self.encoding = norm_utf8_encoding
             return   
@@ -764,6 +889,21 @@ class TextInfo(object):
         # this is binary content.
         self.is_text = False
 
+    _byte_stats = None
+    def _get_byte_stats(self):
+        """Return the `ByteStats` for the (BOM-stripped) head and tail
+        bytes. These are gathered once and then used by the various
+        steps in `_classify_encoding()`.
+        """
+        if self._byte_stats is None:
+            head_bytes = self._accessor.head_bytes
+            if self._accessor.size <= len(head_bytes):
+                tail_bytes = ''  # the head is all of it
+            else:
+                tail_bytes = self._accessor.tail_bytes
+            self._byte_stats = ByteStats(head_bytes, tail_bytes)
+        return self._byte_stats
+
     def _encoding_bozo(self, reason):
         self.encoding_bozo = True
         if self.encoding_bozo_reasons is None:
@@ -1246,6 +1386,206 @@ class TextInfo(object):
             self.file_type_name = "character special"
 
 
+class ByteStats(object):
+    r"""Statistics on the head and tail bytes of some content.
+
+    These are gathered with a handful of C-level passes over the bytes
+    (no per-byte Python code) and are meant to be gathered once and
+    shared by the encoding/binary heuristics.
+
+        >>> stats = ByteStats("#!/bin/sh\r\necho hi\r\n", "")
+        >>> stats.head_nul_count, stats.control_count, stats.crlf_count
+        (0, 0, 2)
+        >>> stats.is_obviously_binary
+        False
+        >>> elf_head = "\x7fELF\x02\x01\x01\x00\x00\x00\x00\x00"
+        >>> ByteStats(elf_head, "").is_obviously_binary
+        True
+        >>> ByteStats("h\x00i\x00\n\x00", "").is_obviously_binary # UTF-16
+        False
+        >>> cjk = u"\u4e01\u3000a\n".encode("utf-16-le")
+        >>> ByteStats(cjk, "").is_obviously_binary
+        False
+
+    UTF-32 text has NUL 16-bit units and, for chars U+0100 to U+1FFF,
+    control bytes, but it is recognizable by its NUL high 16 bits:
+
+        >>> latin = u"\u0101\u0113\u012b\n".encode("utf-32-le")
+        >>> stats = ByteStats(latin, "")
+        >>> stats.control_count > 0, stats.head_nul_unit_count > 0
+        (True, True)
+        >>> stats.is_obviously_binary, stats.bomless_utf_encoding
+        (False, 'utf-32-le')
+        >>> latin = u"\u0101\u0113\u012b\n".encode("utf-32-be")
+        >>> ByteStats(latin, "").is_obviously_binary
+        False
+        >>> ByteStats("\x01\x01\x00\x00\x02\x00\x01\x00", "").is_obviously_binary
+        True
+
+    Control chars alone, without NULs, don't make content binary:
+
+        >>> ByteStats("\x01\x02\x03 old\x1a", "").is_obviously_binary
+        False
+        >>> ByteStats("\x00\x00\x00\x00", "").is_obviously_binary
+        False
+
+    UTF-16 text without a BOM is recognized by some markers:
+
+        >>> ByteStats("<?xml".encode("utf-16-be"), "").bomless_utf_encoding
+        'utf-16-be'
+        >>> ByteStats("# coding: ascii".encode("utf-16-le"), "").bomless_utf_encoding
+        'utf-16-le'
+    """
+    # C0 control chars not normally found in text (i.e. excluding NUL,
+    # which is counted separately, TAB, LF, VT, FF, CR and ESC).
+    _control_chars = ''.join(chr(i) for i in range(1, 32)
+                             if chr(i) not in "\t\n\x0b\x0c\r\x1b")
+    _high_bit_chars = ''.join(chr(i) for i in range(128, 256))
+    _ebcdic_magic = '\x4c\x6f\xa7\x94'
+    # Markers of UTF-16 or UTF-32 text without a BOM, at the start of
+    # the content or anywhere in the head.
+    _bomless_utf_head_markers = ["<?xml", "#!"]
+    _bomless_utf_internal_markers = ["coding"]
+
+    def __init__(self, head_bytes, tail_bytes):
+        head_even_bytes = head_bytes[0::2]
+        head_odd_bytes = head_bytes[1::2]
+        self.head_length = len(head_bytes)
+        # NULs at even and odd offsets in the head.
+        self.head_even_nul_count = head_even_bytes.count('\x00')
+        self.head_odd_nul_count = head_odd_bytes.count('\x00')
+        self.head_nul_count = self.head_even_nul_count \
+                              + self.head_odd_nul_count
+        # NUL 16-bit units (two NULs at an even offset) in the head.
+        self.head_nul_unit_count = array(
+            'H', head_bytes[:self.head_length & ~1]).count(0)
+        # Whether the head is a run of 32-bit units that have NUL high
+        # 16 bits and aren't all NUL, as UTF-32 text (of BMP chars) is.
+        head_units = head_bytes[:self.head_length & ~3]
+        self.head_utf32_le_pattern = bool(
+            head_units and head_units[0::4].strip('\x00')
+            and not head_units[2::4].strip('\x00')
+            and not head_units[3::4].strip('\x00'))
+        self.head_utf32_be_pattern = bool(
+            head_units and head_units[3::4].strip('\x00')
+            and not head_units[0::4].strip('\x00')
+            and not head_units[1::4].strip('\x00'))
+        self.head_is_ebcdic = head_bytes.startswith(self._ebcdic_magic)
+        self.bomless_utf_encoding = None
+        if self.head_nul_count:
+            self.bomless_utf_encoding = self._guess_bomless_utf_encoding(
+                head_bytes, head_even_bytes, head_odd_bytes)
+        # The number of leading head bytes that are valid UTF-8.
+        try:
+            head_bytes.decode("utf-8")
+        except UnicodeDecodeError, ex:
+            self.head_utf8_length = ex.start
+        else:
+            self.head_utf8_length = self.head_length
+
+        sample = head_bytes + tail_bytes
+        self.length = len(sample)
+        self.nul_count = self.head_nul_count + tail_bytes.count('\x00')
+        self.control_count = self.length - len(
+            sample.translate(None, self._control_chars))
+        self.high_bit_count = self.length - len(
+            sample.translate(None, self._high_bit_chars))
+        self.crlf_count = sample.count('\r\n')
+        self.lf_count = sample.count('\n') - self.crlf_count
+        self.cr_count = sample.count('\r') - self.crlf_count
+
+        # Whether Emacs or Vi[m] local variables may be declared. An empty
+        # tail means the head is all of the content.
+        tail = tail_bytes or head_bytes
+        self.head_has_emacs_vars = "-*-" in head_bytes
+        self.tail_has_emacs_vars = "Local Variables" in tail
+        self.head_has_vi_vars = ("vi:" in head_bytes or "ex:" in head_bytes
+                                 or "vim:" in head_bytes)
+        self.tail_has_vi_vars = ("vi:" in tail or "ex:" in tail
+                                 or "vim:" in tail)
+
+    def _guess_bomless_utf_encoding(self, head_bytes, head_even_bytes,
+                                    head_odd_bytes):
+        """Return "utf-32-*" or "utf-16-*" if the head looks like UTF-32
+        or UTF-16 text without a BOM, else None.
+        """
+        if self.head_utf32_le_pattern:
+            return "utf-32-le"
+        if self.head_utf32_be_pattern:
+            return "utf-32-be"
+        utf16_encoding = None
+        for head_marker in self._bomless_utf_head_markers:
+            length = len(head_marker)
+            if head_even_bytes.startswith(head_marker) \
+               and head_odd_bytes[0:length] == '\x00'*length:
+                return "utf-16-le"
+            elif head_odd_bytes.startswith(head_marker) \
+               and head_even_bytes[0:length] == '\x00'*length:
+                return "utf-16-be"
+        for internal_marker in self._bomless_utf_internal_markers:
+            length = len(internal_marker)
+            try:
+                idx = head_even_bytes.index(internal_marker)
+            except ValueError:
+                pass
+            else:
+                if head_odd_bytes[idx:idx+length] == '\x00'*length:
+                    utf16_encoding = "utf-16-le"
+            try:
+                idx = head_odd_bytes.index(internal_marker)
+            except ValueError:
+                pass
+            else:
+                if head_even_bytes[idx:idx+length] == '\x00'*length:
+                    utf16_encoding = "utf-16-be"
+        return utf16_encoding
+
+    def __repr__(self):
+        return ("<ByteStats: %d bytes, %d NULs (%d even, %d odd in head), "
+                "%d control, %d high-bit>"
+                % (self.length, self.nul_count, self.head_even_nul_count,
+                   self.head_odd_nul_count, self.control_count,
+                   self.high_bit_count))
+
+    @property
+    def high_bit_ratio(self):
+        return self.length and float(self.high_bit_count) / self.length
+
+    @property
+    def control_ratio(self):
+        return self.length and float(self.control_count) / self.length
+
+    @property
+    def head_is_utf8(self):
+        """True iff the head is valid UTF-8, allowing for a multi-byte
+        char being cut off at the end of the head.
+        """
+        # '5' because the max num bytes to encode a single char
+        # in any encoding is 6 bytes (in UTF-8).
+        return (self.head_utf8_length == self.head_length
+                or self.head_utf8_length >= Accessor.HEAD_SIZE - 5)
+
+    @property
+    def is_obviously_binary(self):
+        """True iff these bytes are very unlikely to be encoded text.
+
+        Text in an 8-bit encoding or in UTF-8 doesn't contain NULs. Text
+        in UTF-16 has NULs, at both even and odd offsets if it mixes
+        ASCII and e.g. CJK chars, which also give control bytes, but
+        (short of U+0000) never two NULs in one 16-bit unit. Text in
+        UTF-32 has NULs at both even and odd offsets, but only three out
+        of four bytes can be NUL, so we require some non-NUL control
+        characters as well. These can also be UTF-32 of chars U+0100 to
+        U+1FFF, so a head that is consistently UTF-32-like isn't binary.
+        """
+        return (self.head_even_nul_count > 0
+                and self.head_odd_nul_count > 0
+                and self.head_nul_unit_count > 0
+                and self.control_count > 0
+                and not self.head_utf32_le_pattern
+                and not self.head_utf32_be_pattern)
+
+
 def _norm_encoding(encoding):
     """Normalize the encoding name -- where "normalized" is what
     Python's codec's module calls it.
@@ -1261,6 +1601,159 @@ def _norm_encoding(encoding):
         return encoding
 
 
+_ascii_bytes = ''.join(chr(i) for i in range(128))
+_is_ascii_compatible_from_encoding = {}
+def _is_ascii_compatible_encoding(encoding):
+    """Return True iff the given (stateless) encoding decodes ASCII bytes
+    as ASCII, i.e. if a run of ASCII bytes decodes the same with it as
+    with "ascii".
+    """
+    try:
+        return _is_ascii_compatible_from_encoding[encoding]
+    except KeyError:
+        try:
+            compatible = (_ascii_bytes.decode(encoding, 'strict')
+                          == _ascii_bytes.decode("ascii"))
+        except (LookupError, UnicodeError):
+            compatible = False
+        _is_ascii_compatible_from_encoding[encoding] = compatible
+        return compatible
+
+
+#---- classification cache
+
+class TextInfoCache(object):
+    """A persistent cache of `TextInfo.init_from_path()` results.
+
+    Results are stored in an SQLite database keyed on the file's
+    path and identity (device and inode), size and mtime, plus the
+    langinfo Database version and the suggested encoding. A changed
+    file or changed langinfo modules simply miss the cache. The path is
+    part of the key because the language depends on the filename: a
+    renamed file or another hard link to it must not hit.
+
+    Multiple processes can read and write the same cache file. Writes
+    are batched; call `close()` (or `flush()`) to ensure they are saved.
+
+        >> cache = TextInfoCache(".textinfo-cache")
+        >> ti = TextInfo.init_from_path(path, cache=cache)
+        >> cache.hits, cache.misses
+        (0, 1)
+    """
+    # Number of `put()`s between writes.
+    COMMIT_INTERVAL = 100
+    # Seconds to wait for another process's write lock.
+    LOCK_TIMEOUT = 10.0
+
+    hits = 0
+    misses = 0
+
+    def __init__(self, path):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=self.LOCK_TIMEOUT)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS textinfo (
+                file_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                lidb_version TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                info BLOB NOT NULL,
+                PRIMARY KEY (file_id, size, mtime, lidb_version, encoding)
+            )""")
+        self._conn.commit()
+        self._pending = {}  # key -> info blob
+
+    def __repr__(self):
+        return "<TextInfoCache %r>" % self.path
+
+    def _key_from_stat(self, path, stat, lidb, encoding):
+        if not stat.st_ino:
+            # Python 2 on Windows doesn't provide an inode number.
+            return None
+        path = os.path.normcase(os.path.abspath(path))
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        file_id = "%d:%d:%s" % (stat.st_dev, stat.st_ino, path)
+        return (file_id, stat.st_size, stat.st_mtime, lidb.version,
+                encoding or "")
+
+    def get(self, path, stat, lidb, encoding=None):
+        """Return the cached info dict for the given path and stat
+        result, or None.
+        """
+        import cPickle
+        key = self._key_from_stat(path, stat, lidb, encoding)
+        if key is None:
+            self.misses += 1
+            return None
+        if key in self._pending:
+            self.hits += 1
+            return cPickle.loads(str(self._pending[key]))
+        try:
+            row = self._conn.execute("""
+                SELECT info FROM textinfo
+                WHERE file_id=? AND size=? AND mtime=? AND lidb_version=?
+                      AND encoding=?""", key).fetchone()
+        except self._sqlite3.Error, ex:
+            log.debug("%r: lookup error: %s", self, ex)
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cPickle.loads(str(row[0]))
+
+    def put(self, path, stat, lidb, encoding, info):
+        """Store the info dict for the given path and stat result."""
+        import cPickle
+        key = self._key_from_stat(path, stat, lidb, encoding)
+        if key is None:
+            return
+        self._pending[key] = self._sqlite3.Binary(cPickle.dumps(info, 2))
+        if len(self._pending) >= self.COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write pending entries.
+
+        Entries are written in one short transaction so that the write
+        lock isn't held while other processes want to write.
+        """
+        if not self._pending:
+            return
+        try:
+            self._conn.executemany("""
+                INSERT OR REPLACE INTO textinfo
+                    (file_id, size, mtime, lidb_version, encoding, info)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                [key + (blob,) for key, blob in self._pending.items()])
+            self._conn.commit()
+        except self._sqlite3.Error, ex:
+            log.debug("%r: could not store %d entries: %s", self,
+                      len(self._pending), ex)
+            self._conn.rollback()
+        self._pending = {}
+
+    def compact(self, lidb):
+        """Drop entries for other langinfo Database versions and reclaim
+        the space.
+        """
+        self.flush()
+        self._conn.execute("DELETE FROM textinfo WHERE lidb_version != ?",
+                           (lidb.version,))
+        self._conn.commit()
+        self._conn.execute("VACUUM")
+
+    def close(self):
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+
 #---- accessor API
 # The idea here is to abstract accessing the text file content being
 # classified to allow, e.g. classifying content without a file, from
@@ -1282,24 +1775,42 @@ class Accessor(object):
     encoding = None
     text = None
 
+    # Content bigger than this is validated chunk by chunk before it is
+    # decoded. See `decode()`.
+    DECODE_CHUNK_SIZE = pow(2, 20) # 1M
+
     _unsuccessful_encodings = None
+    # Mapping of encoding to the (approximate) offset of the first byte
+    # that could not be decoded with it.
+    decode_error_offsets = None
     def decode(self, encoding):
         """Decodes bytes with the given encoding and, if successful,
         sets `self.text` with the decoded result and returns True.
         Otherwise, returns False.
 
         Side-effects: On success, sets `self.text` and `self.encoding`.
+        On failure, records the error offset in `decode_error_offsets`
+        (if known).
        
         Optimization: First an attempt is made to decode
         `self.head_bytes` instead of all of `self.bytes`. This allows
         for the normal usage in `TextInfo._classify_encoding()` to *not*
         bother fully reading binary files that could not be decoded.
 
+        Optimization: Large content is validated with an incremental
+        decoder, a chunk at a time, stopping at the first error. Only
+        the encoding that works produces `self.text`. For
+        ASCII-compatible encodings validation starts at the first
+        non-ASCII byte (which is only searched for once), so rejecting
+        each candidate encoding in turn doesn't mean decoding all of a
+        mostly-ASCII file each time.
+
         Optimization: Decoding attempts are cached to not bother
         attempting a failed decode twice.
         """
         if self._unsuccessful_encodings is None:
             self._unsuccessful_encodings = set()
+            self.decode_error_offsets = {}
         if encoding in self._unsuccessful_encodings:
             return False
         elif encoding == self.encoding:
@@ -1317,21 +1828,92 @@ class Accessor(object):
             # because a multi-surrogate was cutoff by the head. Ignore
             # the error here, if it is truly not of this encoding, the
             # full file decode will fail.
-            if ex.start >= self.HEAD_SIZE - 5:
+            start = getattr(ex, 'start', 0)
+            if start >= self.HEAD_SIZE - 5:
                 # '5' because the max num bytes to encode a single char
                 # in any encoding is 6 bytes (in UTF-8).
                 pass
             else:
                 self._unsuccessful_encodings.add(encoding)
+                self.decode_error_offsets[encoding] = start
+                return False
+
+        if self.size > self.DECODE_CHUNK_SIZE:
+            error_offset = self._decode_error_offset(encoding)
+            if error_offset is not None:
+                log.debug("%s: %r decode error at offset %d", self,
+                          encoding, error_offset)
+                self._unsuccessful_encodings.add(encoding)
+                self.decode_error_offsets[encoding] = error_offset
                 return False
         try:
-            self.text = self.bytes.decode(encoding, 'strict')
+            self.text = self._decoded_bytes(encoding)
         except UnicodeError, ex:
             self._unsuccessful_encodings.add(encoding)
+            self.decode_error_offsets[encoding] = getattr(ex, 'start', 0)
             return False
         self.encoding = encoding
         return True
 
+    def _decode_error_offset(self, encoding):
+        """Return the offset of the first error decoding all the bytes
+        with the given encoding, or None if there is no error.
+
+        The returned offset is approximate: it may be off by the few
+        bytes of a partial character held over by the incremental
+        decoder between chunks.
+        """
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)('strict')
+        except LookupError:
+            return None  # no incremental decoder: just try to decode
+        bytes = self.bytes
+        length = len(bytes)
+        chunk_size = self.DECODE_CHUNK_SIZE
+        if _is_ascii_compatible_encoding(encoding):
+            start = self._ascii_prefix_length()
+        else:
+            start = 0
+        for pos in xrange(start, length, chunk_size):
+            try:
+                decoder.decode(bytes[pos:pos+chunk_size],
+                               pos + chunk_size >= length)
+            except UnicodeDecodeError, ex:
+                return pos + ex.start
+            except UnicodeError:
+                # e.g. the incremental UTF-16 decoder requires a BOM,
+                # unlike decode(): leave it to the full decode
+                return None
+        return None
+
+    _ascii_prefix_length_cache = None
+    def _ascii_prefix_length(self):
+        """Return the number of leading ASCII bytes."""
+        if self._ascii_prefix_length_cache is None:
+            bytes = self.bytes
+            length = len(bytes)
+            chunk_size = self.DECODE_CHUNK_SIZE
+            for pos in xrange(0, length, chunk_size):
+                try:
+                    bytes[pos:pos+chunk_size].decode("ascii")
+                except UnicodeDecodeError, ex:
+                    self._ascii_prefix_length_cache = pos + ex.start
+                    break
+            else:
+                self._ascii_prefix_length_cache = length
+        return self._ascii_prefix_length_cache
+
+    def _decoded_bytes(self, encoding):
+        """Return all of the bytes decoded with the given encoding.
+        
+        Raises UnicodeError if the bytes cannot be decoded.
+        """
+        return self.bytes.decode(encoding, 'strict')
+
+    @property
+    def size(self):
+        return len(self.bytes)
+
 
 class PathAccessor(Accessor):
     """Accessor API for a path."""
@@ -1344,9 +1926,15 @@ class PathAccessor(Accessor):
     _bytes = None
     _bytes_tail = None
 
-    def __init__(self, path, follow_symlinks=False):
+    def __init__(self, path, follow_symlinks=False, stat=None):
+        """
+        @param stat {stat result} can be given if the caller already
+            stat'd (or lstat'd, as appropriate) the path.
+        """
         self.path = path
         self.follow_symlinks = follow_symlinks
+        if stat is not None:
+            self._stat_cache = stat
 
     def __str__(self):
         return "path `%s'" % self.path 
@@ -1473,9 +2061,133 @@ class PathAccessor(Accessor):
         return self._bytes
 
 
+class MmapPathAccessor(PathAccessor):
+    """Accessor API for a (large) path that avoids copying the content.
+
+    The file is mmap'd. The head and tail bytes are (small) copies, but
+    `bytes`, `bytes_range()` and the BOM-stripped content are zero-copy
+    buffer views on the mapping, and decoding works directly from the
+    mapping. This means the only full-size copy of the content is the
+    decoded `text`.
+    """
+    # Use this accessor for regular files at least this big.
+    MIN_SIZE = pow(2, 20) # 1M
+
+    _mmap = None
+    _offset = 0  # start of the content in `_mmap` (i.e. after a BOM)
+
+    def close(self):
+        if self._mmap is not None and not isinstance(self._mmap, str):
+            self._mmap.close()
+        self._mmap = None
+        PathAccessor.close(self)
+
+    def _map(self):
+        import mmap
+        try:
+            self._file = open(self.path, 'rb')
+            try:
+                self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError), ex:
+                # E.g. the file is on a filesystem that doesn't support
+                # mmap. Fallback to reading the content.
+                log.debug("could not mmap %r (%s): reading it", self.path, ex)
+                self._mmap = self._file.read()
+        except Exception, ex:
+            log.warn("Could not read file: %r due to: %r", self.path, ex)
+            raise
+
+    def strip_bom(self, bom):
+        if self._mmap is None:
+            self._map()
+        assert self._mmap[self._offset:self._offset+len(bom)] == bom
+        self._offset += len(bom)
+
+    @property
+    def head_bytes(self):
+        if self._mmap is None:
+            self._map()
+        return self._mmap[self._offset:self._offset+self.HEAD_SIZE]
+
+    @property
+    def head_4_bytes(self):
+        if self._mmap is None:
+            self._map()
+        return self._mmap[self._offset:self._offset+4]
+
+    @property
+    def tail_bytes(self):
+        if self._mmap is None:
+            self._map()
+        return self._mmap[max(self._offset, len(self._mmap)-self.TAIL_SIZE):]
+
+    def bytes_range(self, start, end):
+        if self._mmap is None:
+            self._map()
+        start, end, step = slice(start, end).indices(
+            len(self._mmap) - self._offset)
+        return buffer(self._mmap, self._offset + start, max(end - start, 0))
+
+    @property
+    def bytes(self):
+        if self._mmap is None:
+            self._map()
+        return buffer(self._mmap, self._offset)
+
+    def _decoded_bytes(self, encoding):
+        decoder = codecs.getdecoder(encoding)
+        try:
+            return decoder(self.bytes, 'strict')[0]
+        except TypeError:
+            # Some (pure Python) codecs only accept a string.
+            return decoder(str(self.bytes), 'strict')[0]
+
+
 
 #---- internal support stuff
 
+_g_worker_cache = None  # a worker process's TextInfoCache
+def _init_textinfo_worker(langinfo_dirs, cache_path):
+    """Initialize a `textinfo_from_paths()` worker process.
+
+    The langinfo Database is built once here and then reused for every
+    path handled by this worker.
+    """
+    global _g_worker_cache
+    langinfo.set_default_dirs(langinfo_dirs)
+    langinfo.get_default_database()
+    if cache_path is not None:
+        from multiprocessing.util import Finalize
+        _g_worker_cache = TextInfoCache(cache_path)
+        Finalize(_g_worker_cache, _g_worker_cache.close, exitpriority=10)
+
+def _textinfo_from_path_job(args, cache=None):
+    """Classify one path for `textinfo_from_paths()`.
+
+    Returns (<path>, <textinfo>, None) or, if the path could not be
+    stat'd or read, (<path>, None, <exception>).
+    """
+    path, encoding, follow_symlinks, quick_determine_lang = args
+    if isinstance(path, tuple):
+        path, stat = path
+    else:
+        stat = None
+    try:
+        ti = TextInfo.init_from_path(path, encoding=encoding,
+                    follow_symlinks=follow_symlinks,
+                    quick_determine_lang=quick_determine_lang,
+                    cache=cache, stat=stat)
+    except EnvironmentError, ex:
+        return (path, None, ex)
+    return (path, ti, None)
+
+def _textinfo_from_path_worker_job(args):
+    """`_textinfo_from_path_job()` in a worker process, with the cache
+    opened by `_init_textinfo_worker()`.
+    """
+    return _textinfo_from_path_job(args, _g_worker_cache)
+
 # Recipe: regex_from_encoded_pattern (1.0)
 def _regex_from_encoded_pattern(s):
     """'foo'    -> re.compile(re.escape('foo'))
@@ -1583,7 +2295,7 @@ def _one_line_summary_from_text(text, length=78,
     return summary
 
 
-# Recipe: paths_from_path_patterns (0.5)
+# Recipe: paths_from_path_patterns (0.5+)
 def _should_include_path(path, includes, excludes):
     """Return True iff the given path should be included."""
     from os.path import basename
@@ -1613,6 +2325,76 @@ def _should_include_path(path, includes, excludes):
             return False
     return True
 
+class _PathFilter(object):
+    """A compiled form of `_should_include_path()` for filtering many
+    names with the same includes and excludes.
+    """
+    def __init__(self, includes, excludes):
+        self.include_re = regex_from_glob_patterns(includes)
+        self.exclude_re = regex_from_glob_patterns(excludes)
+
+    def include(self, name):
+        """Return True iff the given basename should be included."""
+        name = os.path.normcase(name)
+        if self.include_re is not None and not self.include_re.match(name):
+            return False
+        return not self.exclude(name)
+
+    def exclude(self, name):
+        """Return True iff the given basename is excluded."""
+        return (self.exclude_re is not None
+                and self.exclude_re.match(os.path.normcase(name)) is not None)
+
+try:
+    from scandir import scandir as _scandir  # the "scandir" package
+except ImportError:
+    _scandir = None
+
+class _DirEntry(object):
+    """A minimal `os.DirEntry` for when scandir is not available.
+
+    The entry is lstat'd (once) on demand and only symlinks are stat'd
+    again, so this still costs fewer syscalls than separate islink(),
+    isdir() and (l)stat() calls.
+    """
+    _lstat = None
+    _stat = None
+
+    def __init__(self, top, name):
+        self.name = name
+        self.path = os.path.join(top, name)
+
+    def __repr__(self):
+        return "<_DirEntry %r>" % self.name
+
+    def stat(self, follow_symlinks=True):
+        from stat import S_ISLNK
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and S_ISLNK(self._lstat.st_mode):
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        return self._lstat
+
+    def is_symlink(self):
+        from stat import S_ISLNK
+        return S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        from stat import S_ISDIR
+        try:
+            return S_ISDIR(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False  # e.g. a broken symlink
+
+def _dir_entries(top):
+    """Return a list of `os.DirEntry`-like entries for the given dir."""
+    if _scandir is not None:
+        return list(_scandir(top))
+    else:
+        return [_DirEntry(top, name) for name in os.listdir(top)]
+
 def _walk(top, topdown=True, onerror=None, follow_symlinks=False):
     """A version of `os.walk()` with a couple differences regarding symlinks.
     
@@ -1627,9 +2409,17 @@ def _walk(top, topdown=True, onerror=None, follow_symlinks=False):
        within the same tree. This is my understanding of how `find -L
        DIR` works.
 
+    Also, this generates (<dirpath>, <dir-entries>, <nondir-entries>)
+    where the entries are `os.DirEntry`-like objects (with `name`,
+    `path`, `is_dir()`, `is_symlink()` and `stat()`). Using scandir
+    (where available) means file types usually come for free with the
+    directory listing instead of costing stat calls. As with
+    `os.walk()`, removing entries from <dir-entries> when topdown=True
+    prunes the walk.
+
     TODO: put as a separate recipe
     """
-    from os.path import join, isdir, islink, abspath
+    from os.path import join, abspath
 
     # We may not have read permission for top, in which case we can't
     # get a list of the files the directory contains.  os.path.walk
@@ -1637,45 +2427,34 @@ def _walk(top, topdown=True, onerror=None, follow_symlinks=False):
     # minor reason when (say) a thousand readable directories are still
     # left to visit.  That logic is copied here.
     try:
-        names = os.listdir(top)
+        entries = _dir_entries(top)
     except OSError, err:
         if onerror is not None:
             onerror(err)
         return
 
     dirs, nondirs = [], []
-    if follow_symlinks:
-        for name in names:
-            if isdir(join(top, name)):
-                dirs.append(name)
-            else:
-                nondirs.append(name)
-    else:
-        for name in names:
-            path = join(top, name)
-            if islink(path):
-                nondirs.append(name)
-            elif isdir(path):
-                dirs.append(name)
-            else:
-                nondirs.append(name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=follow_symlinks):
+            dirs.append(entry)
+        else:
+            nondirs.append(entry)
 
     if topdown:
         yield top, dirs, nondirs
-    for name in dirs:
-        path = join(top, name)
-        if follow_symlinks and islink(path):
+    for entry in dirs:
+        if follow_symlinks and entry.is_symlink():
             # Only walk this path if it links deeper in the same tree.
             top_abs = abspath(top)
-            link_abs = abspath(join(top, os.readlink(path)))
+            link_abs = abspath(join(top, os.readlink(entry.path)))
             if not link_abs.startswith(top_abs + os.sep):
                 continue
-        for x in _walk(path, topdown, onerror, follow_symlinks=follow_symlinks):
+        for x in _walk(entry.path, topdown, onerror,
+                       follow_symlinks=follow_symlinks):
             yield x
     if not topdown:
         yield top, dirs, nondirs
 
-_NOT_SPECIFIED = ("NOT", "SPECIFIED")
 def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
                               recursive=True, includes=[], excludes=[],
                               skip_dupe_dirs=False,
@@ -1758,7 +2537,28 @@ def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
                         # under dirs; if none, call on_error(PATH*)
                         # callback
 
-    TODO: perf improvements (profile, stat just once)
+    See `_path_entries_from_path_patterns()` to also get the directory
+    entries (with cached file type and stat info) for walked paths.
+    """
+    for path, entry in _path_entries_from_path_patterns(path_patterns,
+            files=files, dirs=dirs, recursive=recursive, includes=includes,
+            excludes=excludes, skip_dupe_dirs=skip_dupe_dirs,
+            follow_symlinks=follow_symlinks, on_error=on_error):
+        yield path
+
+def _path_entries_from_path_patterns(path_patterns, files=True,
+                                     dirs="never", recursive=True,
+                                     includes=[], excludes=[],
+                                     skip_dupe_dirs=False,
+                                     follow_symlinks=False,
+                                     on_error=_NOT_SPECIFIED):
+    """Generate (<path>, <entry>) for the paths that
+    `_paths_from_path_patterns()` (which see for the arguments) would
+    generate.
+
+    <entry> is the `os.DirEntry`-like object for a path found while
+    walking a dir (see `_walk()`), and None for a path given directly
+    or by a glob pattern.
     """
     from os.path import basename, exists, isdir, join, normpath, abspath, \
                         lexists, islink, realpath
@@ -1770,6 +2570,7 @@ def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
 
     if skip_dupe_dirs:
         searched_dirs = set()
+    path_filter = _PathFilter(includes, excludes)
 
     for path_pattern in path_patterns:
         # Determine the set of paths matching this path_pattern.
@@ -1808,18 +2609,18 @@ def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
                 if (dirs == "always"
                     or (dirs == "if-not-recursive" and not recursive)
                    ) and _should_include_path(path, includes, excludes):
-                    yield path
+                    yield path, None
 
                 # However, if recursive, 'includes' should NOT affect
                 # whether a dir is recursed into. Otherwise you could
                 # not:
                 #   script -r --include="*.py" DIR
                 if recursive and _should_include_path(path, [], excludes):
-                    for dirpath, dirnames, filenames in _walk(path, 
+                    for dirpath, dir_entries, file_entries in _walk(path,
                             follow_symlinks=follow_symlinks):
                         dir_indeces_to_remove = []
-                        for i, dirname in enumerate(dirnames):
-                            d = join(dirpath, dirname)
+                        for i, entry in enumerate(dir_entries):
+                            d = entry.path
                             if skip_dupe_dirs:
                                 canon_d = normpath(abspath(d))
                                 if follow_symlinks:
@@ -1830,21 +2631,87 @@ def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
                                 else:
                                     searched_dirs.add(canon_d)
                             if dirs == "always" \
-                               and _should_include_path(d, includes, excludes):
-                                yield d
-                            if not _should_include_path(d, [], excludes):
+                               and path_filter.include(entry.name):
+                                yield d, entry
+                            # Prune excluded dirs before descending.
+                            if path_filter.exclude(entry.name):
                                 dir_indeces_to_remove.append(i)
                         for i in reversed(dir_indeces_to_remove):
-                            del dirnames[i]
+                            del dir_entries[i]
                         if files:
-                            for filename in sorted(filenames):
-                                f = join(dirpath, filename)
-                                if _should_include_path(f, includes, excludes):
-                                    yield f
+                            file_entries.sort(key=lambda e: e.name)
+                            for entry in file_entries:
+                                if path_filter.include(entry.name):
+                                    yield entry.path, entry
 
             elif files and _should_include_path(path, includes, excludes):
+                yield path, None
+
+def _paths_and_stats_from_path_entries(path_entries, follow_symlinks):
+    """Generate (<path>, <stat-result-or-None>) from (<path>, <entry>)."""
+    for path, entry in path_entries:
+        stat = None
+        if entry is not None:
+            try:
+                stat = entry.stat(follow_symlinks=follow_symlinks)
+            except OSError:
+                pass  # leave it to the accessor to report
+        yield path, stat
+
+def _bench_walk(num_files=100000):
+    """Benchmark `_paths_from_path_patterns()` against a walk using
+    `os.listdir()`, `islink()`/`isdir()` and per-pattern `fnmatch()`
+    (the implementation before scandir was used) on a generated tree.
+    """
+    import shutil
+    import tempfile
+    import time
+    from fnmatch import fnmatch
+    from os.path import isdir, islink
+
+    excludes = [".svn", "CVS", ".hg", ".git", ".bzr"]
+    includes = ["*.py", "*.txt", "*.xml", "*.html"]
+    exts = [".py", ".txt", ".xml", ".html", ".c", ".o", ".js", ".css"]
+
+    def listdir_walk(top):
+        for name in sorted(os.listdir(top)):
+            path = join(top, name)
+            if [p for p in excludes if fnmatch(name, p)]:
+                continue
+            if not islink(path) and isdir(path):
+                for p in listdir_walk(path):
+                    yield p
+            elif [p for p in includes if fnmatch(name, p)]:
                 yield path
 
+    top = tempfile.mkdtemp(prefix="textinfo-bench-")
+    try:
+        files_per_dir = 100
+        for i in range(max(num_files // files_per_dir, 1)):
+            d = join(top, "d%d" % (i // 10), "sub%d" % (i % 10))
+            os.makedirs(d)
+            for j in range(files_per_dir):
+                open(join(d, "f%d%s" % (j, exts[j % len(exts)])), 'w').close()
+            if i % 10 == 0:
+                os.makedirs(join(d, ".svn"))
+                open(join(d, ".svn", "entries.txt"), 'w').close()
+
+        timings = []
+        for name, walk in [
+                ("listdir", lambda: listdir_walk(top)),
+                ("scandir" if _scandir is not None else "scandir (emulated)",
+                 lambda: _paths_from_path_patterns([top],
+                            includes=includes, excludes=excludes))]:
+            start = time.time()
+            count = 0
+            for path in walk():
+                count += 1
+            timings.append((name, count, time.time() - start))
+        for name, count, elapsed in timings:
+            print "%-20s %7d paths in %.3fs" % (name, count, elapsed)
+    finally:
+        shutil.rmtree(top)
+
 
 class _NoReflowFormatter(optparse.IndentedHelpFormatter):
     """An optparse formatter that does NOT reflow the description."""
@@ -1922,6 +2789,15 @@ def main(argv):
                            "language. Things like specialization, emacs/vi "
                            "local vars, full decoding, are skipped.")
     parser.add_option("--encoding", help="suggested encoding for input files")
+    parser.add_option("-j", "--jobs", type="int", metavar="N",
+                      help="number of worker processes to classify with "
+                           "(default 1, use 0 for one per CPU)")
+    parser.add_option("--unordered", dest="ordered", action="store_false",
+                      help="with '-j', print results as soon as they are "
+                           "ready rather than in path order")
+    parser.add_option("--cache", dest="cache_path", metavar="PATH",
+                      help="persistent classification cache file (created "
+                           "if necessary) to speed up repeated runs")
     parser.add_option("-f", "--format",
                       help="format of output: summary (default), dict")
     parser.add_option("-x", "--exclude", dest="excludes", action="append",
@@ -1931,7 +2807,8 @@ def main(argv):
     parser.set_defaults(log_level=logging.INFO, encoding=None, recursive=False,
                         follow_symlinks=False, format="summary",
                         excludes=[".svn", "CVS", ".hg", ".git", ".bzr"],
-                        quick_determine_lang=False)
+                        quick_determine_lang=False, jobs=1, ordered=True,
+                        cache_path=None)
     opts, args = parser.parse_args()
     log.setLevel(opts.log_level)
     if opts.log_level > logging.INFO:
@@ -1948,26 +2825,44 @@ def main(argv):
                 yield line.rstrip("\r\n")
         path_patterns = args_from_stdin()
 
-    for path in _paths_from_path_patterns(path_patterns, excludes=opts.excludes,
-                    recursive=opts.recursive, 
+    path_entries = _path_entries_from_path_patterns(path_patterns,
+                    excludes=opts.excludes,
+                    recursive=opts.recursive,
                     dirs="if-not-recursive",
-                    follow_symlinks=opts.follow_symlinks):
-        try:
-            ti = textinfo_from_path(path, encoding=opts.encoding,
-                                    follow_symlinks=opts.follow_symlinks,
-                                    quick_determine_lang=opts.quick_determine_lang)
-        except OSError, ex:
-            log.error("%s: %s", path, ex)
-            continue
-        if opts.format == "summary":
-            print ti.as_summary()
-        elif opts.format == "dict":
-            d = ti.as_dict()
-            if "text" in d:
-                del d["text"]
-            pprint(d)
-        else:
-            raise TextInfoError("unknown output format: %r" % opts.format)
+                    follow_symlinks=opts.follow_symlinks)
+    if opts.jobs == 1:
+        # Hand on the stat info from walking dirs (free on Windows,
+        # and otherwise no more than classifying would stat anyway).
+        paths = _paths_and_stats_from_path_entries(path_entries,
+                                                   opts.follow_symlinks)
+    else:
+        # Leave stat'ing to the worker processes.
+        paths = (path for path, entry in path_entries)
+    def on_error(path, ex):
+        log.error("%s: %s", path, ex)
+    if opts.cache_path:
+        cache = TextInfoCache(opts.cache_path)
+    else:
+        cache = None
+    try:
+        for ti in textinfo_from_paths(paths, encoding=opts.encoding,
+                        follow_symlinks=opts.follow_symlinks,
+                        quick_determine_lang=opts.quick_determine_lang,
+                        jobs=opts.jobs, ordered=opts.ordered,
+                        on_error=on_error, cache=cache):
+            if opts.format == "summary":
+                print ti.as_summary()
+            elif opts.format == "dict":
+                d = ti.as_dict()
+                if "text" in d:
+                    del d["text"]
+                pprint(d)
+            else:
+                raise TextInfoError("unknown output format: %r" % opts.format)
+    finally:
+        if cache is not None:
+            log.debug("cache: %d hits, %d misses", cache.hits, cache.misses)
+            cache.close()
 
 
 if __name__ == "__main__":
@@ -1976,6 +2871,8 @@ if __name__ == "__main__":
         if "--self-test" in sys.argv:
             import doctest
             retval = doctest.testmod()[0]
+        elif "--bench-walk" in sys.argv:
+            retval = _bench_walk()
         else:
             retval = main(sys.argv)
     except SystemExit:
@@ -40,6 +40,7 @@ r"""Basic text manipulation utilities."""
 import os
 import sys
 import re
+from bisect import bisect_right
 from pprint import pprint
 import logging
 
@@ -178,6 +179,44 @@ def break_up_lines(text, max_line_width=80):
     return '\n'.join(lines)
 
 
+class LineIndex(object):
+    r"""An index of the line start offsets in a text, for O(log n)
+    conversions between char offsets and (line, col) positions.
+
+    Lines and columns are 0-based and only "\n" ends a line.
+
+        >>> index = LineIndex("abc\ndef\n\nghi")
+        >>> len(index)
+        4
+        >>> index.line_col_from_offset(5)
+        (1, 1)
+        >>> index.line_col_from_offset(8)
+        (2, 0)
+        >>> index.offset_from_line_col(3, 2)
+        11
+    """
+    def __init__(self, text):
+        self.line_starts = line_starts = [0]
+        find = text.find
+        pos = find("\n")
+        while pos != -1:
+            pos += 1
+            line_starts.append(pos)
+            pos = find("\n", pos)
+
+    def __len__(self):
+        return len(self.line_starts)
+
+    def line_col_from_offset(self, offset):
+        """Return the (line, col) for the given offset."""
+        line = bisect_right(self.line_starts, offset) - 1
+        return line, offset - self.line_starts[line]
+
+    def offset_from_line_col(self, line, col):
+        """Return the offset of the given (line, col)."""
+        return self.line_starts[line] + col
+
+
 
 #---- self-test
 